@@ -16,18 +16,73 @@ class Config:
                 env.read_env()
                 cls.__instance = super(Config, cls).__new__(cls)
                 cls.__instance.bot_token = env('BOT_TOKEN')
+                cls.__instance.bot_mode = env('BOT_MODE', default='polling')  # polling или webhook
+                cls.__instance.webhook_url = env('WEBHOOK_URL', default=None)  # внешний адрес, например https://bot.example.com
+                cls.__instance.webhook_path = env('WEBHOOK_PATH', default='/webhook')
+                cls.__instance.webhook_secret = env('WEBHOOK_SECRET', default=None)
+                cls.__instance.webhook_host = env('WEBHOOK_HOST', default='0.0.0.0')
+                cls.__instance.webhook_port = env.int('WEBHOOK_PORT', default=8080)
+                cls.__instance.webhook_max_connections = env.int('WEBHOOK_MAX_CONNECTIONS', default=40)
                 cls.__instance.openai_key = env('OPENAI_KEY')
+                cls.__instance.openai_base_url = env('OPENAI_BASE_URL', default=None)  # например, локальный мок-сервер
+                cls.__instance.openai_timeout = env.float('OPENAI_TIMEOUT', default=60.0)
+                cls.__instance.openai_max_retries = env.int('OPENAI_MAX_RETRIES', default=2)
+                cls.__instance.openai_max_concurrency = env.int('OPENAI_MAX_CONCURRENCY', default=20)
+                cls.__instance.openai_tokens_per_minute = env.int('OPENAI_TOKENS_PER_MINUTE', default=30000)  # 0 - без ограничения
+                cls.__instance.openai_max_queue = env.int('OPENAI_MAX_QUEUE', default=100)
+                cls.__instance.openai_stream = env.bool('OPENAI_STREAM', default=True)
+                # Telegram ограничивает частоту редактирования сообщений, поэтому правки склеиваем
+                cls.__instance.stream_edit_interval = env.float('STREAM_EDIT_INTERVAL', default=1.5)
+                cls.__instance.stream_edit_min_chars = env.int('STREAM_EDIT_MIN_CHARS', default=40)
+                cls.__instance.response_cache_enabled = env.bool('RESPONSE_CACHE_ENABLED', default=True)
+                cls.__instance.response_cache_size = env.int('RESPONSE_CACHE_SIZE', default=5000000)  # в символах
+                cls.__instance.response_cache_ttl = env.int('RESPONSE_CACHE_TTL', default=86400)
+                cls.__instance.response_cache_shared = env.bool('RESPONSE_CACHE_SHARED', default=False)
+                cls.__instance.response_cache_max_rows = env.int('RESPONSE_CACHE_MAX_ROWS', default=100000)
                 cls.__instance.min_prompt_len = env.int('MIN_PROMPT_LEN', default=5)
                 cls.__instance.max_prompt_len = env.int('MAX_PROMPT_LEN', default=1000)
                 cls.__instance.max_query_len = env.int('MAX_QUERY_LEN', default=1000)
+                # detail=low: модель смотрит на фото 512x512 за фиксированные 85 токенов; high/auto - плитками по 512
+                cls.__instance.photo_detail = env('PHOTO_DETAIL', default='low')
+                cls.__instance.photo_target_size = env.int('PHOTO_TARGET_SIZE', default=512)  # по длинной стороне
+                cls.__instance.dispatch_max_in_flight = env.int('DISPATCH_MAX_IN_FLIGHT', default=100)  # апдейтов одновременно
+                cls.__instance.media_group_latency = env.float('MEDIA_GROUP_LATENCY', default=0.6)  # секунды
+                cls.__instance.photo_cache_enabled = env.bool('PHOTO_CACHE_ENABLED', default=True)
+                cls.__instance.photo_cache_size = env.int('PHOTO_CACHE_SIZE', default=5000)  # в записях
+                cls.__instance.photo_cache_ttl = env.int('PHOTO_CACHE_TTL', default=86400)
+                cls.__instance.photo_cache_distance = env.int('PHOTO_CACHE_DISTANCE', default=6)  # из 64 бит dHash
                 cls.__instance.command_list = [f"/{cmd.strip()}" for cmd in env('COMMAND_LIST').split(',')]
                 cls.__instance.daily_limit_free = env.int('DAILY_LIMIT_FREE', default=10)
                 cls.__instance.daily_limit_paid = env.int('DAILY_LIMIT_PAID', default=50)
                 cls.__instance.database_url = env('DATABASE_URL')
+                cls.__instance.db_pool_min_size = env.int('DB_POOL_MIN_SIZE', default=2)
+                cls.__instance.db_pool_max_size = env.int('DB_POOL_MAX_SIZE', default=10)
+                cls.__instance.db_max_inactive_lifetime = env.float('DB_MAX_INACTIVE_LIFETIME', default=300.0)
+                cls.__instance.db_statement_cache_size = env.int('DB_STATEMENT_CACHE_SIZE', default=100)
+                cls.__instance.db_statement_timeout = env.int('DB_STATEMENT_TIMEOUT', default=0)  # мс, 0 - без ограничения
                 cls.__instance.max_cache_size = env.int('MAX_CACHE_SIZE', default=10000)
+                # несколько реплик бота: FSM в Postgres, счетчики запросов без кэша в памяти процесса
+                cls.__instance.shared_state = env.bool('SHARED_STATE', default=False)
+                cls.__instance.quota_ledger = env.bool('QUOTA_LEDGER', default=True)
+                cls.__instance.quota_flush_interval = env.float('QUOTA_FLUSH_INTERVAL', default=5.0)  # секунды
+                cls.__instance.quota_flush_max_pending = env.int('QUOTA_FLUSH_MAX_PENDING', default=500)
                 cls.__instance.ttl = env.int('TTL', default=86400)
+                cls.__instance.wiki_enabled = env.bool('WIKI_ENABLED', default=True)  # сверять распознанное фото с Википедией
+                cls.__instance.wiki_language = env('WIKI_LANGUAGE', default='ru')  # если язык пользователя не поддерживается
+                # разделы, в которых ищем статью на языке пользователя (language_code из Telegram)
+                cls.__instance.wiki_languages = [lang.strip() for lang in env('WIKI_LANGUAGES', default='ru,en').split(',')
+                                                 if lang.strip()]
+                cls.__instance.wiki_top_k = env.int('WIKI_TOP_K', default=3)  # сколько кандидатов искать
+                cls.__instance.wiki_max_concurrency = env.int('WIKI_MAX_CONCURRENCY', default=5)
+                cls.__instance.wiki_timeout = env.float('WIKI_TIMEOUT', default=10.0)
+                cls.__instance.wiki_thumb_width = env.int('WIKI_THUMB_WIDTH', default=800)
+                cls.__instance.wiki_cache_path = env('WIKI_CACHE_PATH', default='wiki_cache.sqlite3')
+                cls.__instance.wiki_cache_size = env.int('WIKI_CACHE_SIZE', default=10000)
+                cls.__instance.wiki_cache_revalidate = env.int('WIKI_CACHE_REVALIDATE', default=7 * 86400)  # секунды
                 cls.__instance.default_prompts = [f"{p.strip()}" for p in env('DEFAULT_PROMPTS').split(';')]
                 cls.__instance.admin = env.int('ADMIN', default=683708227)
+                cls.__instance.prompt_cache_size = env.int('PROMPT_CACHE_SIZE', default=10000)  # пользователей
+                cls.__instance.prompt_cache_ttl = env.int('PROMPT_CACHE_TTL', default=3600)
                 cls.__instance.max_prompts_per_user = env.int('MAX_PROMPTS_PER_USER', default=10)
                 cls.__instance.provider_token = env('PROVIDER_TOKEN')
                 cls.__instance.currency = env('CURRENCY')
@@ -1,11 +1,21 @@
 import asyncio
 import logging
 from datetime import date, datetime
-from typing import Optional, List, Any
+from typing import Callable, Dict, MutableMapping, Optional, List, Any, Tuple
 import asyncpg
 
+from database.ledger import QuotaLedger
+from database.migrations import apply_migrations, sync_system_prompts
 from models.prompt import Prompt
+from models.reservation import Reservation
 from models.user import User
+from time_delta import get_today
+
+
+# канал уведомлений: пользователь оплатил подписку, его отметку об исчерпанном лимите надо снять на всех репликах
+LIMIT_RESET_CHANNEL = 'limit_reset'
+# канал уведомлений: промпты пользователя изменились, закэшированный список надо сбросить на всех репликах
+PROMPTS_CHANGED_CHANNEL = 'prompts_changed'
 
 
 class SingletonMeta(type):  # метаклассы управляют поведением классов, а не экземпляров
@@ -18,6 +28,97 @@ class SingletonMeta(type):  # метаклассы управляют повед
         return cls._instances[cls]
 
 
+# Часто выполняемые запросы: готовятся один раз на каждое соединение пула
+STATEMENTS = {
+    # суточный счетчик сбрасывается лениво: если requests_date не сегодняшняя ($2), он считается нулевым
+    'get_user': '''
+        SELECT user_id, telegram_id, is_admin,
+               CASE WHEN requests_date = $2 THEN daily_requests ELSE 0 END AS daily_requests,
+               total_requests
+        FROM users
+        WHERE telegram_id=$1
+    ''',
+    'get_quota_state': '''
+        SELECT is_admin, CASE WHEN requests_date = $2 THEN daily_requests ELSE 0 END AS daily_requests
+        FROM users
+        WHERE telegram_id=$1
+    ''',
+    # резерв запроса: лимит проверяется и счетчик увеличивается одним запросом; $3 - лимит пользователя без оплаты, $4 - с оплатой
+    'reserve_request': '''
+        UPDATE users
+        SET daily_requests = CASE WHEN requests_date = $2 THEN daily_requests + 1 ELSE 1 END,
+            requests_date = $2,
+            total_requests = total_requests + 1
+        WHERE telegram_id = $1
+          AND CASE WHEN requests_date = $2 THEN daily_requests ELSE 0 END
+              < CASE WHEN is_admin THEN $4 ELSE LEAST($3, $4) END
+        RETURNING daily_requests
+    ''',
+    # возврат резерва, если ответ так и не был доставлен; $2 - день резерва
+    'release_request': '''
+        UPDATE users
+        SET daily_requests = CASE WHEN requests_date = $2 THEN GREATEST(daily_requests - 1, 0)
+                                  ELSE daily_requests END,
+            total_requests = GREATEST(total_requests - 1, 0)
+        WHERE telegram_id = $1
+    ''',
+    # общие промпты (с отрицательным id) поверх своих: скрытые и отредактированные пользователем заменяются его строками
+    'get_prompts_by_user': '''
+        SELECT id, user_id, prompt
+        FROM (
+            SELECT -s.id AS id, $1::bigint AS user_id, s.prompt, s.position, 0 AS own_id
+            FROM system_prompts s
+            WHERE NOT EXISTS (SELECT 1 FROM prompts p WHERE p.user_id = $1 AND p.system_prompt_id = s.id)
+            UNION ALL
+            SELECT p.id, p.user_id, p.prompt, COALESCE(s.position, 2147483647), p.id
+            FROM prompts p
+            LEFT JOIN system_prompts s ON s.id = p.system_prompt_id
+            WHERE p.user_id = $1 AND NOT p.hidden
+        ) merged
+        ORDER BY position, own_id
+    ''',
+    'get_prompt_by_id': '''
+        SELECT id, user_id, prompt
+        FROM prompts
+        WHERE id = $1 AND NOT hidden
+        UNION ALL
+        SELECT -id, 0, prompt
+        FROM system_prompts
+        WHERE id = -$1
+    ''',
+}
+
+
+# рейтинг пользователей: $1 - сколько, $2 - сегодняшняя дата; order_by проверяет вызывающий
+def top_users_query(order_by: str) -> str:
+    # в рейтинг за сегодня попадают только пользователи, чей счетчик относится к сегодняшней дате
+    where = "WHERE requests_date = $2" if order_by == 'daily_requests' else ""
+    return f"""
+        SELECT user_id, telegram_id, is_admin,
+               CASE WHEN requests_date = $2 THEN daily_requests ELSE 0 END AS daily_requests,
+               total_requests
+        FROM users
+        {where}
+        ORDER BY users.{order_by} DESC
+        LIMIT $1
+    """
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Соединение, которое хранит свои подготовленные запросы из STATEMENTS."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+    async def get_statement(self, name: str, refresh: bool = False):
+        statement = self.prepared.get(name)
+        if statement is None or refresh:
+            statement = await self.prepare(STATEMENTS[name])
+            self.prepared[name] = statement
+        return statement
+
+
 # Инициализация базы данных
 def ensure_pool(func):  # декоратор для автоматической проверки инициализации пула соединений
     async def wrapper(self, *args, **kwargs):
@@ -30,27 +131,61 @@ def ensure_pool(func):  # декоратор для автоматической
 
 
 class Database(metaclass=SingletonMeta):
-    def __init__(self, database_url, acquire_timeout: int = 10):
+    def __init__(self, database_url, acquire_timeout: int = 10, min_size: int = 2, max_size: int = 10,
+                 max_inactive_connection_lifetime: float = 300.0, statement_cache_size: int = 100,
+                 statement_timeout: int = 0):
         self.database_url = database_url
         self.pool: Optional[asyncpg.pool.Pool] = None
         self._pool_lock = asyncio.Lock()  # Добавляем блокировку для предотвращения гонок
         self.acquire_timeout = acquire_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        self.statement_cache_size = statement_cache_size
+        self.statement_timeout = statement_timeout  # мс, 0 - без ограничения
+        self.ledger: Optional[QuotaLedger] = None  # счетчики запросов в памяти, если включены
+        self._listener: Optional[asyncpg.Connection] = None  # отдельное соединение для LISTEN
+        self._subscriptions: Dict[str, Callable] = {}  # каналы LISTEN, которые восстанавливаются после обрыва
+        self._reconnect_task: Optional[asyncio.Task] = None
+        # отметки (telegram_id, дата) об исчерпанном лимите, общие с ThrottlingMiddleware
+        self.limit_cache: Optional[MutableMapping] = None
+        self.prompt_catalog = None  # кэш промптов пользователей (handlers.prompt_catalog), если подключен
 
     async def create_pool(self):
         async with self._pool_lock:  # Используем блокировку для предотвращения параллельных вызовов
             if self.pool is None:
                 try:
-                    self.pool = await asyncpg.create_pool(dsn=self.database_url)
+                    self.pool = await asyncpg.create_pool(
+                        dsn=self.database_url,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        max_inactive_connection_lifetime=self.max_inactive_connection_lifetime,
+                        statement_cache_size=self.statement_cache_size,
+                        connection_class=PreparedConnection,
+                        # параметры соединения, а не SET: пул делает RESET ALL при каждом возврате соединения
+                        server_settings=self._server_settings(),
+                    )
                     logging.info("Соединение с базой данных установлено")
                 except (asyncpg.PostgresError, Exception) as e:
                     logging.error(f"Ошибка при установлении соединения с базой данных: {e}")
                     raise
 
+    def _server_settings(self) -> dict:
+        settings = {}
+        if self.statement_timeout:
+            settings['statement_timeout'] = str(int(self.statement_timeout))
+        return settings
+
     async def close_pool(self):
         async with self._pool_lock:  # Используем блокировку для предотвращения параллельных вызовов
             if self.pool is not None:
                 try:
                     logging.info("Пытаемся закрыть пул соединений")
+                    if self._reconnect_task is not None:
+                        self._reconnect_task.cancel()
+                    listener, self._listener = self._listener, None  # закрытие не должно вызвать переподключение
+                    if listener is not None and not listener.is_closed():
+                        await listener.close()
                     await self.pool.close()
                     self.pool = None
                     logging.info("Соединение с базой данных закрыто")
@@ -89,6 +224,35 @@ class Database(metaclass=SingletonMeta):
             logging.error(f"Неизвестная ошибка при выполнении запроса: {e}")
             raise
 
+    async def _run_prepared(self, method: str, name: str, *args: Any) -> Any:
+        try:
+            async with self.pool.acquire(timeout=self.acquire_timeout) as connection:
+                statement = await connection.get_statement(name)
+                try:
+                    return await getattr(statement, method)(*args)
+                except (asyncpg.exceptions.InvalidCachedStatementError,
+                        asyncpg.exceptions.FeatureNotSupportedError):
+                    # схема таблицы поменялась, и старый план больше не годится - готовим запрос заново
+                    statement = await connection.get_statement(name, refresh=True)
+                    return await getattr(statement, method)(*args)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса {name}: {e}")
+            raise
+        except asyncio.TimeoutError as e:
+            logging.error(f"Таймаут при аренде соединения: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при выполнении запроса {name}: {e}")
+            raise
+
+    @ensure_pool
+    async def fetchrow_prepared(self, name: str, *args: Any) -> Optional[asyncpg.Record]:
+        return await self._run_prepared('fetchrow', name, *args)
+
+    @ensure_pool
+    async def fetch_prepared(self, name: str, *args: Any) -> List[asyncpg.Record]:
+        return await self._run_prepared('fetch', name, *args)
+
     @ensure_pool
     async def fetch(self, query: str, *args: Any) -> List[asyncpg.Record]:
         try:
@@ -107,24 +271,15 @@ class Database(metaclass=SingletonMeta):
 
     @ensure_pool
     async def init_db(self):
+        from config import config
         try:
             logging.info("Запуск инициализации базы данных")
-            # тройные кавычки для многострочных запросов
-            await self.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    is_admin BOOLEAN NOT NULL DEFAULT FALSE,
-                    daily_requests INTEGER NOT NULL DEFAULT 0,
-                    total_requests INTEGER NOT NULL DEFAULT 0,
-                    last_payment_date DATE DEFAULT NULL
-                );
-                CREATE TABLE IF NOT EXISTS prompts (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                    prompt TEXT NOT NULL
-                );
-            ''')
+            # схема описана версионными миграциями в database/migrations.py
+            async with self.pool.acquire(timeout=self.acquire_timeout) as connection:
+                applied = await apply_migrations(connection)
+                await sync_system_prompts(connection, config.default_prompts)
+            if applied:
+                logging.info(f"Применены миграции: {applied}")
             logging.info("Инициализация базы данных успешно завершена")
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка при инициализации базы данных: {e}")
@@ -140,19 +295,13 @@ class Database(metaclass=SingletonMeta):
         if not isinstance(is_admin, bool):
             raise ValueError("is_admin должен быть булевым значением")
         try:
-            # значения передаются как параметры запроса, поэтому в asyncpg автоматически экранируются
-            result = await self.execute('''
+            # значения передаются как параметры запроса, поэтому в asyncpg автоматически экранируются;
+            # промпты по умолчанию не копируются - они общие для всех (system_prompts)
+            await self.execute('''
                 INSERT INTO users (telegram_id, is_admin)
                 VALUES ($1, $2)
                 ON CONFLICT (telegram_id) DO NOTHING
             ''', telegram_id, is_admin)
-
-            n = await self.get_user_prompts_count(telegram_id)
-            if n == 0:
-                # Добавляем промпты по умолчанию
-                from config import config
-                for prompt in config.default_prompts:
-                    await self.add_user_prompt(telegram_id, prompt)
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка при добавлении пользователя: {e}")
             raise
@@ -166,11 +315,7 @@ class Database(metaclass=SingletonMeta):
             raise ValueError("telegram_id должен быть целым числом")
 
         try:
-            result = await self.fetchrow('''
-                SELECT user_id, telegram_id, is_admin, daily_requests, total_requests 
-                FROM users 
-                WHERE telegram_id=$1
-            ''', telegram_id)
+            result = await self.fetchrow_prepared('get_user', telegram_id, get_today())
             if result:
                 return User(**result)
             return None
@@ -186,6 +331,9 @@ class Database(metaclass=SingletonMeta):
         if not isinstance(telegram_id, int):
             raise ValueError("telegram_id должен быть целым числом")
         try:
+            if self.ledger is not None:
+                return (await self.ledger.get_entry(telegram_id)).is_admin
+
             result = await self.fetchrow('''
                 SELECT is_admin FROM users WHERE telegram_id=$1
                 ''', telegram_id)
@@ -202,26 +350,84 @@ class Database(metaclass=SingletonMeta):
             raise
 
     @ensure_pool
-    async def increment_requests(self, telegram_id: int) -> Optional[int]:
+    async def reserve_request(self, telegram_id: int) -> Optional[Reservation]:
         if not isinstance(telegram_id, int):
             raise ValueError("telegram_id должен быть целым числом")
+        from config import config  # Lazy import to avoid circular dependency
+        free_limit, paid_limit = config.daily_limit_free, config.daily_limit_paid
+        if not free_limit:
+            logging.warning("В настройках не установлено значение дневного лимита на запросы")
+            free_limit = paid_limit = 2 ** 31 - 1
         try:
-            result = await self.fetchrow('''
+            today = get_today()
+            if self.ledger is not None:
+                reservation = await self.ledger.reserve(telegram_id, free_limit, paid_limit)
+            else:
+                row = await self.fetchrow_prepared('reserve_request', telegram_id, today, free_limit, paid_limit)
+                if row is None and await self.get_quota_state(telegram_id, today) is None:
+                    await self.add_user(telegram_id)
+                    logging.warning(f"Пользователь {telegram_id} был не зарегистрирован, но мы оперативно исправили")
+                    row = await self.fetchrow_prepared('reserve_request', telegram_id, today, free_limit, paid_limit)
+                reservation = Reservation(row['daily_requests'], today) if row else None
+
+            if reservation is None and self.limit_cache is not None:
+                self.limit_cache[(telegram_id, today)] = True  # дальше отказываем, не обращаясь к БД
+            return reservation
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при резервировании запроса: {e}")
+            raise
+
+    @ensure_pool
+    async def release_request(self, telegram_id: int, reservation: Reservation) -> None:
+        if not isinstance(telegram_id, int):
+            raise ValueError("telegram_id должен быть целым числом")
+        try:
+            if self.ledger is not None and self.ledger.release(telegram_id, reservation):
+                return
+            await self.fetchrow_prepared('release_request', telegram_id, reservation.day)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при возврате запроса: {e}")
+            raise
+
+    @ensure_pool
+    async def get_quota_state(self, telegram_id: int, today: date) -> Optional[asyncpg.Record]:
+        if not isinstance(telegram_id, int):
+            raise ValueError("telegram_id должен быть целым числом")
+        try:
+            return await self.fetchrow_prepared('get_quota_state', telegram_id, today)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при получении счетчиков пользователя: {e}")
+            raise
+
+    @ensure_pool
+    async def apply_request_increments(self, telegram_ids: List[int], daily: List[int], total: List[int],
+                                       days: List[date]) -> None:
+        # одно обновление на всю пачку: массивы разворачиваются в таблицу приращений
+        try:
+            await self.execute('''
                 UPDATE users
-                SET daily_requests = daily_requests + 1,
-                    total_requests = total_requests + 1
-                WHERE telegram_id = $1
-                RETURNING daily_requests
-            ''', telegram_id)
-            # Убедимся, что результат не пуст
-            if result and 'daily_requests' in result:
-                return result["daily_requests"]
-            return None  # или какое-то значение по умолчанию
+                SET daily_requests = CASE WHEN users.requests_date = d.day
+                                          THEN users.daily_requests + d.daily
+                                          ELSE d.daily END,
+                    requests_date = d.day,
+                    total_requests = users.total_requests + d.total
+                FROM unnest($1::bigint[], $2::int[], $3::int[], $4::date[]) AS d(telegram_id, daily, total, day)
+                WHERE users.telegram_id = d.telegram_id
+            ''', telegram_ids, daily, total, days)
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса: {e}")
             raise
         except Exception as e:
-            logging.error(f"Неизвестная ошибка при обновлении запросов: {e}")
+            logging.error(f"Неизвестная ошибка при записи счетчиков запросов: {e}")
             raise
 
     @ensure_pool
@@ -241,6 +447,12 @@ class Database(metaclass=SingletonMeta):
             if result == 0:
                 logging.warning(f"Не удалось обновить дату платежа для пользователя {telegram_id}")
                 return False
+            if self.ledger is not None:
+                self.ledger.set_admin(telegram_id, True)
+            try:
+                await self.notify(LIMIT_RESET_CHANNEL, str(telegram_id))
+            except Exception as e:
+                logging.error(f"Не удалось разослать снятие лимита пользователя {telegram_id}: {e}")
             return True
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса: {e}")
@@ -249,18 +461,6 @@ class Database(metaclass=SingletonMeta):
             logging.error(f"Неизвестная ошибка при обновлении даты платежа: {e}")
             raise
 
-    @ensure_pool
-    async def reset_daily_requests(self) -> None:
-        try:
-            await self.execute('UPDATE users SET daily_requests = 0')
-            logging.info("Ежедневные запросы для всех пользователей успешно сброшены")
-        except asyncpg.PostgresError as e:
-            logging.error(f"Ошибка выполнения запроса: {e}")
-            raise
-        except Exception as e:
-            logging.error(f"Неизвестная ошибка при сбросе ежедневных запросов: {e}")
-            raise
-
     @ensure_pool
     async def get_top_users(self, order_by: str = 'daily_requests', limit: int = 10) -> List[User]:
         if order_by not in {'daily_requests', 'total_requests'}:
@@ -270,13 +470,7 @@ class Database(metaclass=SingletonMeta):
             raise ValueError("limit должно быть положительным целым числом")
 
         try:
-            query = f"""
-                SELECT user_id, telegram_id, is_admin, daily_requests, total_requests
-                FROM users
-                ORDER BY {order_by} DESC
-                LIMIT $1
-            """
-            results = await self.fetch(query, limit)
+            results = await self.fetch(top_users_query(order_by), limit, get_today())
             return [User(**result) for result in results] if results else []
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса: {e}")
@@ -285,42 +479,12 @@ class Database(metaclass=SingletonMeta):
             logging.error(f"Неизвестная ошибка при получении топ пользователей: {e}")
             raise
 
-    @ensure_pool
-    async def check_limits(self, telegram_id: int) -> bool:
-        if not isinstance(telegram_id, int):
-            raise ValueError("telegram_id должен быть целым числом")
-        from config import config  # Lazy import to avoid circular dependency
-        if not config.daily_limit_free:
-            logging.warning("В настройках не установлено значение дневного лимита на запросы")
-            return True
-
-        try:
-            user = await self.fetchrow('SELECT is_admin, daily_requests FROM users WHERE telegram_id=$1', telegram_id)
-            if not user:
-                await self.add_user(telegram_id)
-                logging.warning(f"Пользователь {telegram_id} был не зарегистрирован, но мы оперативно исправили")
-                user = await self.fetchrow('SELECT is_admin, daily_requests FROM users WHERE telegram_id=$1', telegram_id)
-
-            if user and user['daily_requests'] < config.daily_limit_paid and (user['is_admin'] or user['daily_requests'] < config.daily_limit_free):
-                return True
-            return False
-        except asyncpg.PostgresError as e:
-            logging.error(f"Ошибка выполнения запроса: {e}")
-            raise
-        except Exception as e:
-            logging.error(f"Неизвестная ошибка при проверке лимита запросов: {e}")
-            raise
-
     @ensure_pool
     async def get_prompts_by_user(self, telegram_id: int) -> List[Prompt]:
         if not isinstance(telegram_id, int):
             raise ValueError("telegram_id должен быть целым числом")
         try:
-            results = await self.fetch('''
-                SELECT id, user_id, prompt
-                FROM prompts
-                WHERE user_id = $1
-            ''', telegram_id)
+            results = await self.fetch_prepared('get_prompts_by_user', telegram_id)
 
             if not results:  # Проверяем, есть ли результаты
                 return []
@@ -333,27 +497,6 @@ class Database(metaclass=SingletonMeta):
             logging.error(f"Неизвестная ошибка при получении промптов пользователя: {e}")
             raise
 
-    @ensure_pool
-    async def get_user_prompts_count(self, telegram_id: int) -> int:
-        if not isinstance(telegram_id, int):
-            raise ValueError("telegram_id должен быть целым числом")
-        try:
-            row = await self.fetchrow('''
-                SELECT COUNT(*) as count
-                FROM prompts
-                WHERE user_id = $1
-            ''', telegram_id)
-
-            if row and 'count' in row:  # Проверяем, наличие результата и ключа 'count'
-                return row['count']
-            return 0
-        except asyncpg.PostgresError as e:
-            logging.error(f"Ошибка выполнения запроса: {e}")
-            raise
-        except Exception as e:
-            logging.error(f"Неизвестная ошибка при подсчете числа промптов пользователя: {e}")
-            raise
-
     @ensure_pool
     async def get_users_count(self) -> int:
         try:
@@ -396,7 +539,8 @@ class Database(metaclass=SingletonMeta):
             row = await self.fetchrow('''
                 SELECT SUM(daily_requests) as count
                 FROM users
-            ''')
+                WHERE requests_date = $1
+            ''', get_today())
 
             if row and 'count' in row:  # Проверяем, наличие результата и ключа 'count'
                 return row['count']
@@ -413,11 +557,7 @@ class Database(metaclass=SingletonMeta):
         if not isinstance(prompt_id, int):
             raise ValueError("prompt_id должен быть целым числом")
         try:
-            result = await self.fetchrow('''
-                SELECT id, user_id, prompt
-                FROM prompts
-                WHERE id = $1
-            ''', prompt_id)
+            result = await self.fetchrow_prepared('get_prompt_by_id', prompt_id)
             if result and 'id' in result and 'user_id' in result and 'prompt' in result:
                 return Prompt(**result)  # распаковка словаря (синтаксический сахар)
             return None
@@ -433,11 +573,7 @@ class Database(metaclass=SingletonMeta):
         if not isinstance(prompt_id, int):
             raise ValueError("prompt_id должен быть целым числом")
         try:
-            result = await self.fetchrow('''
-                SELECT prompt
-                FROM prompts
-                WHERE id = $1
-            ''', prompt_id)
+            result = await self.fetchrow_prepared('get_prompt_by_id', prompt_id)
             if result and 'prompt' in result:
                 return result['prompt']  # распаковка словаря (синтаксический сахар)
             return None
@@ -480,6 +616,7 @@ class Database(metaclass=SingletonMeta):
                 INSERT INTO prompts (user_id, prompt)
                 VALUES ($1, $2)
             ''', telegram_id, prompt)
+            await self._prompts_changed(telegram_id)
             return True
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса на добавление промпта: {e}")
@@ -490,17 +627,41 @@ class Database(metaclass=SingletonMeta):
             return False
 
     @ensure_pool
-    async def delete_user_prompt(self, prompt_id: int) -> bool:
+    async def delete_user_prompt(self, prompt_id: int, telegram_id: Optional[int] = None) -> bool:
         if not isinstance(prompt_id, int):
             raise ValueError("prompt_id должен быть целым числом")
+        if prompt_id < 0 and not isinstance(telegram_id, int):
+            raise ValueError("для общего промпта telegram_id должен быть целым числом")
         try:
-            result = await self.execute('''
-                DELETE FROM prompts
-                WHERE id = $1
-            ''', prompt_id)
-            if not result == 'DELETE 1':
+            if prompt_id < 0:
+                # общий промпт не удаляется, а скрывается у этого пользователя
+                owner = await self.fetchrow('''
+                    INSERT INTO prompts (user_id, prompt, system_prompt_id, hidden)
+                    SELECT $2, prompt, id, TRUE FROM system_prompts WHERE id = -$1
+                    ON CONFLICT (user_id, system_prompt_id) WHERE system_prompt_id IS NOT NULL
+                    DO UPDATE SET hidden = TRUE
+                    RETURNING user_id
+                ''', prompt_id, telegram_id)
+            else:
+                # правка общего промпта остается отметкой hidden, иначе вместо нее снова появится оригинал
+                owner = await self.fetchrow('''
+                    WITH hidden AS (
+                        UPDATE prompts SET hidden = TRUE
+                        WHERE id = $1 AND system_prompt_id IS NOT NULL
+                        RETURNING user_id
+                    ), deleted AS (
+                        DELETE FROM prompts
+                        WHERE id = $1 AND system_prompt_id IS NULL
+                        RETURNING user_id
+                    )
+                    SELECT user_id FROM hidden
+                    UNION ALL
+                    SELECT user_id FROM deleted
+                ''', prompt_id)
+            if owner is None:
                 logging.error(f"Попытка удалить несуществующий промпт {prompt_id}")
                 return False
+            await self._prompts_changed(owner['user_id'])
             return True
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса на удаление промпта: {e}")
@@ -510,22 +671,223 @@ class Database(metaclass=SingletonMeta):
             return False
 
     @ensure_pool
-    async def edit_user_prompt(self, prompt_id: int, prompt_text: str) -> bool:
+    async def edit_user_prompt(self, prompt_id: int, prompt_text: str, telegram_id: Optional[int] = None) -> bool:
         if not isinstance(prompt_id, int) or not isinstance(prompt_text, str):
             raise ValueError("prompt_id должен быть целым числом")
+        if prompt_id < 0 and not isinstance(telegram_id, int):
+            raise ValueError("для общего промпта telegram_id должен быть целым числом")
         try:
-            result = await self.execute('''
-                UPDATE prompts
-                SET prompt = $1
-                WHERE id = $2
-            ''', prompt_text, prompt_id)
-            if not result == 'UPDATE 1':
+            if prompt_id < 0:
+                # общий промпт копируется пользователю только при правке
+                owner = await self.fetchrow('''
+                    INSERT INTO prompts (user_id, prompt, system_prompt_id)
+                    SELECT $3, $1, id FROM system_prompts WHERE id = -$2
+                    ON CONFLICT (user_id, system_prompt_id) WHERE system_prompt_id IS NOT NULL
+                    DO UPDATE SET prompt = EXCLUDED.prompt, hidden = FALSE
+                    RETURNING user_id
+                ''', prompt_text, prompt_id, telegram_id)
+            else:
+                owner = await self.fetchrow('''
+                    UPDATE prompts
+                    SET prompt = $1
+                    WHERE id = $2 AND NOT hidden
+                    RETURNING user_id
+                ''', prompt_text, prompt_id)
+            if owner is None:
                 logging.error(f"Не удалось отредактировать промпт {prompt_id}")
                 return False
+            await self._prompts_changed(owner['user_id'])
             return True
         except asyncpg.PostgresError as e:
             logging.error(f"Ошибка выполнения запроса на редактирование промпта: {e}")
             return False
         except Exception as e:
             logging.error(f"Неизвестная ошибка при редактировании промпта: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    async def _prompts_changed(self, telegram_id: int):
+        if self.prompt_catalog is not None:
+            self.prompt_catalog.invalidate(telegram_id)
+        try:
+            await self.notify(PROMPTS_CHANGED_CHANNEL, str(telegram_id))  # для остальных реплик
+        except Exception as e:
+            logging.error(f"Не удалось разослать изменение промптов пользователя {telegram_id}: {e}")
+
+    @ensure_pool
+    async def get_cached_response(self, key: str, ttl: int) -> Optional[Tuple[str, float]]:
+        try:
+            row = await self.fetchrow('''
+                SELECT response, latency
+                FROM response_cache
+                WHERE key = $1 AND created_at > now() - make_interval(secs => $2)
+            ''', key, float(ttl))
+            if row:
+                return row['response'], row['latency']
+            return None
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при чтении кэша ответов: {e}")
+            raise
+
+    @ensure_pool
+    async def put_cached_response(self, key: str, response: str, latency: float) -> None:
+        try:
+            await self.execute('''
+                INSERT INTO response_cache (key, response, latency)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (key) DO UPDATE
+                SET response = EXCLUDED.response,
+                    latency = EXCLUDED.latency,
+                    created_at = now()
+            ''', key, response, latency)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при записи в кэш ответов: {e}")
+            raise
+
+    @ensure_pool
+    async def prune_response_cache(self, ttl: int, max_rows: int) -> None:
+        try:
+            await self.execute('''
+                DELETE FROM response_cache
+                WHERE created_at <= now() - make_interval(secs => $1)
+            ''', float(ttl))
+            # сверх лимита удаляем самые старые записи
+            await self.execute('''
+                DELETE FROM response_cache
+                WHERE key IN (
+                    SELECT key FROM response_cache
+                    ORDER BY created_at DESC
+                    OFFSET $1
+                )
+            ''', max_rows)
+            logging.info("Кэш ответов в базе данных очищен от устаревших записей")
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при очистке кэша ответов: {e}")
+            raise
+
+    async def listen(self, channel: str, callback: Callable) -> None:
+        # LISTEN занимает соединение навсегда, поэтому берем его не из пула
+        self._subscriptions[channel] = callback
+        try:
+            if self._listener is None or self._listener.is_closed():
+                await self._connect_listener()
+            else:
+                await self._listener.add_listener(channel, callback)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка при подписке на канал {channel}: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при подписке на канал {channel}: {e}")
+            raise
+
+    async def _connect_listener(self):
+        connection = await asyncpg.connect(dsn=self.database_url)
+        try:
+            for channel, callback in self._subscriptions.items():
+                await connection.add_listener(channel, callback)
+        except BaseException:
+            await connection.close()
+            raise
+        connection.add_termination_listener(self._on_listener_terminated)
+        self._listener = connection
+
+    def _on_listener_terminated(self, connection: asyncpg.Connection):
+        if connection is not self._listener:
+            return  # соединение закрыли мы сами
+        logging.warning("Соединение для LISTEN разорвано, переподключаемся")
+        self._listener = None
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect_listener())
+
+    async def _reconnect_listener(self, max_delay: float = 60.0):
+        delay = 1.0
+        while True:
+            try:
+                await self._connect_listener()
+                break
+            except Exception as e:
+                logging.error(f"Не удалось переподключить LISTEN, повтор через {delay:.0f} с: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+        # уведомления, пришедшие во время обрыва, потеряны - сбрасываем все, что они могли бы сбросить
+        if self.limit_cache is not None:
+            self.limit_cache.clear()
+        if self.prompt_catalog is not None:
+            self.prompt_catalog.entries.clear()
+        logging.info(f"Подписки LISTEN восстановлены: {list(self._subscriptions)}")
+
+    @ensure_pool
+    async def notify(self, channel: str, payload: str) -> None:
+        await self.execute('SELECT pg_notify($1, $2)', channel, payload)
+
+    @ensure_pool
+    async def get_fsm(self, key: str) -> Optional[asyncpg.Record]:
+        try:
+            return await self.fetchrow('''
+                SELECT state, data::text AS data
+                FROM fsm_storage
+                WHERE key = $1
+            ''', key)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при чтении состояния FSM: {e}")
+            raise
+
+    @ensure_pool
+    async def set_fsm_state(self, key: str, state: Optional[str]) -> None:
+        try:
+            await self.execute('''
+                INSERT INTO fsm_storage (key, state)
+                VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE
+                SET state = EXCLUDED.state,
+                    updated_at = now()
+            ''', key, state)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при записи состояния FSM: {e}")
+            raise
+
+    @ensure_pool
+    async def set_fsm_data(self, key: str, data: str) -> None:
+        try:
+            await self.execute('''
+                INSERT INTO fsm_storage (key, data)
+                VALUES ($1, $2::jsonb)
+                ON CONFLICT (key) DO UPDATE
+                SET data = EXCLUDED.data,
+                    updated_at = now()
+            ''', key, data)
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при записи данных FSM: {e}")
+            raise
+
+    @ensure_pool
+    async def prune_fsm_storage(self) -> None:
+        # после state.clear() остаются пустые строки, их удаляем раз в сутки
+        try:
+            await self.execute('''
+                DELETE FROM fsm_storage
+                WHERE state IS NULL AND data = '{}'::jsonb
+            ''')
+        except asyncpg.PostgresError as e:
+            logging.error(f"Ошибка выполнения запроса: {e}")
+            raise
+        except Exception as e:
+            logging.error(f"Неизвестная ошибка при очистке состояний FSM: {e}")
+            raise
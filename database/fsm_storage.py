@@ -0,0 +1,43 @@
+import json
+from typing import Any, Dict, Optional, TYPE_CHECKING
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+if TYPE_CHECKING:
+    from database.db import Database
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage, общее для всех реплик бота.
+
+    Диспетчер создается раньше пула соединений, поэтому БД подключается позже через attach_db."""
+
+    def __init__(self, db: Optional['Database'] = None):
+        self.db = db
+
+    def attach_db(self, db: 'Database'):
+        self.db = db
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+                 getattr(key, 'business_connection_id', None) or "", key.destiny)
+        return ":".join(str(part) for part in parts)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.db.set_fsm_state(self._key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self.db.get_fsm(self._key(key))
+        return row['state'] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.db.set_fsm_data(self._key(key), json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self.db.get_fsm(self._key(key))
+        return json.loads(row['data']) if row else {}
+
+    async def close(self) -> None:
+        pass  # пул соединений закрывает Database
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+from datetime import date
+from typing import Dict, Optional, Set, TYPE_CHECKING
+
+from models.reservation import Reservation
+from time_delta import get_today
+
+if TYPE_CHECKING:
+    from database.db import Database
+
+
+class QuotaEntry:
+    __slots__ = ('daily_requests', 'day', 'is_admin', 'pending_daily', 'pending_total')
+
+    def __init__(self, daily_requests: int, day: date, is_admin: bool):
+        self.daily_requests = daily_requests
+        self.day = day  # дата, к которой относится daily_requests
+        self.is_admin = is_admin
+        self.pending_daily = 0  # еще не записанные в БД приращения
+        self.pending_total = 0
+
+    def roll_over(self, today: date):
+        # наступил новый день: суточный счетчик считаем нулевым, общий продолжаем копить
+        if self.day != today:
+            self.day = today
+            self.daily_requests = 0
+            self.pending_daily = 0
+
+
+class QuotaLedger:
+    """Счетчики запросов пользователей в памяти процесса.
+
+    Состояние пользователя читается из БД один раз при первом обращении, дальше лимиты
+    проверяются и счетчики увеличиваются локально, а приращения пачками сбрасываются
+    в таблицу users раз в flush_interval секунд или как только накопится max_pending
+    пользователей с несохраненными счетчиками."""
+
+    def __init__(self, db: 'Database', flush_interval: float, max_pending: int):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.entries: Dict[int, QuotaEntry] = {}
+        self._dirty: Set[int] = set()  # пользователи с несохраненными приращениями
+        self._flush_needed = asyncio.Event()
+        self._hydrating: Dict[int, asyncio.Future] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка при сбросе счетчиков запросов в БД: {e}")
+
+    async def get_entry(self, telegram_id: int) -> QuotaEntry:
+        entry = self.entries.get(telegram_id)
+        if entry is not None:
+            entry.roll_over(get_today())
+            return entry
+
+        # параллельные апдейты одного пользователя не должны читать его из БД дважды
+        future = self._hydrating.get(telegram_id)
+        if future is not None:
+            return await future
+
+        future = asyncio.get_running_loop().create_future()
+        self._hydrating[telegram_id] = future
+        try:
+            today = get_today()
+            row = await self.db.get_quota_state(telegram_id, today)
+            if row is None:
+                await self.db.add_user(telegram_id)
+                logging.warning(f"Пользователь {telegram_id} был не зарегистрирован, но мы оперативно исправили")
+                row = await self.db.get_quota_state(telegram_id, today)
+            if row is None:
+                raise ValueError(f"Не удалось получить счетчики пользователя {telegram_id}")
+            entry = QuotaEntry(row['daily_requests'], today, row['is_admin'])
+            entry.roll_over(get_today())  # пока мы читали, могла наступить полночь
+            self.entries[telegram_id] = entry
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # чтобы не было предупреждения, если ожидающих нет
+            raise
+        finally:
+            del self._hydrating[telegram_id]
+
+    async def reserve(self, telegram_id: int, daily_limit_free: int, daily_limit_paid: int) -> Optional[Reservation]:
+        entry = await self.get_entry(telegram_id)
+        # между проверкой и увеличением нет await, поэтому параллельный резерв вклиниться не может
+        limit = daily_limit_paid if entry.is_admin else min(daily_limit_free, daily_limit_paid)
+        if entry.daily_requests >= limit:
+            return None
+        self._add(telegram_id, entry, 1, 1)
+        return Reservation(entry.daily_requests, entry.day)
+
+    def release(self, telegram_id: int, reservation: Reservation) -> bool:
+        entry = self.entries.get(telegram_id)
+        if entry is None:
+            return False  # запись уже выгружена, возвращать резерв придется в БД
+        entry.roll_over(get_today())
+        # резерв прошлого дня уменьшает только общий счетчик
+        daily = -1 if entry.day == reservation.day and entry.daily_requests > 0 else 0
+        self._add(telegram_id, entry, daily, -1)
+        return True
+
+    def _add(self, telegram_id: int, entry: QuotaEntry, daily: int, total: int):
+        entry.daily_requests += daily
+        entry.pending_daily += daily
+        entry.pending_total += total
+        self._dirty.add(telegram_id)
+        if len(self._dirty) >= self.max_pending:
+            self._flush_needed.set()
+
+    def set_admin(self, telegram_id: int, is_admin: bool):
+        entry = self.entries.get(telegram_id)
+        if entry is not None:
+            entry.is_admin = is_admin
+
+    async def flush(self):
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, set()
+            telegram_ids, daily, total, days = [], [], [], []
+            for telegram_id in dirty:
+                entry = self.entries.get(telegram_id)
+                # после полуночи возможны одни суточные приращения (вчерашний резерв вернули, сегодняшний взяли)
+                if entry is None or not (entry.pending_daily or entry.pending_total):
+                    continue
+                telegram_ids.append(telegram_id)
+                daily.append(entry.pending_daily)
+                total.append(entry.pending_total)
+                days.append(entry.day)
+                entry.pending_daily = 0
+                entry.pending_total = 0
+            if not telegram_ids:
+                return
+            try:
+                await self.db.apply_request_increments(telegram_ids, daily, total, days)
+                logging.debug(f"Сброшены счетчики запросов {len(telegram_ids)} пользователей")
+            except BaseException:
+                # возвращаем несохраненные приращения, чтобы записать их в следующий раз
+                for telegram_id, d, t, day in zip(telegram_ids, daily, total, days):
+                    entry = self.entries.get(telegram_id)
+                    if entry is not None:
+                        if entry.day == day:
+                            entry.pending_daily += d
+                        entry.pending_total += t
+                        self._dirty.add(telegram_id)
+                raise
+
+    def evict_stale(self):
+        # вчерашние записи без несохраненных приращений больше не нужны, они прочитаются заново
+        today = get_today()
+        for telegram_id in list(self.entries):
+            entry = self.entries[telegram_id]
+            if entry.day != today and not (entry.pending_daily or entry.pending_total):
+                del self.entries[telegram_id]
@@ -0,0 +1,145 @@
+import logging
+from typing import List, NamedTuple
+
+import asyncpg
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    sql: str
+
+
+# Миграции применяются по порядку и ровно один раз; уже выпущенные миграции не редактируем,
+# любые изменения схемы добавляем новой записью в конец списка
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Начальная схема", '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+            daily_requests INTEGER NOT NULL DEFAULT 0,
+            total_requests INTEGER NOT NULL DEFAULT 0,
+            last_payment_date DATE DEFAULT NULL
+        );
+        CREATE TABLE IF NOT EXISTS prompts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            prompt TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            latency REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    '''),
+    Migration(2, "Индексы для промптов пользователя, рейтингов и платных пользователей", '''
+        CREATE INDEX IF NOT EXISTS prompts_user_id_idx ON prompts (user_id);
+        CREATE INDEX IF NOT EXISTS users_daily_requests_idx ON users (daily_requests);
+        CREATE INDEX IF NOT EXISTS users_total_requests_idx ON users (total_requests);
+        CREATE INDEX IF NOT EXISTS users_last_payment_date_idx ON users (last_payment_date)
+            WHERE last_payment_date IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS response_cache_created_at_idx ON response_cache (created_at);
+    '''),
+    Migration(3, "Ленивый суточный сброс: дата, к которой относится daily_requests", '''
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS requests_date DATE DEFAULT NULL;
+        UPDATE users SET requests_date = (now() AT TIME ZONE 'Europe/Moscow')::date WHERE daily_requests > 0;
+        DROP INDEX IF EXISTS users_daily_requests_idx;
+        CREATE INDEX IF NOT EXISTS users_requests_date_daily_idx ON users (requests_date, daily_requests);
+    '''),
+    Migration(4, "Общее для всех реплик хранилище состояний FSM", '''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    '''),
+    Migration(5, "Общие промпты по умолчанию вместо копий у каждого пользователя", '''
+        CREATE TABLE IF NOT EXISTS system_prompts (
+            id SERIAL PRIMARY KEY,
+            prompt TEXT UNIQUE NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0
+        );
+        -- строка пользователя с system_prompt_id - его правка общего промпта (или отметка об удалении, если hidden)
+        ALTER TABLE prompts ADD COLUMN IF NOT EXISTS system_prompt_id INTEGER
+            REFERENCES system_prompts(id) ON DELETE SET NULL;
+        ALTER TABLE prompts ADD COLUMN IF NOT EXISTS hidden BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE UNIQUE INDEX IF NOT EXISTS prompts_user_system_prompt_idx ON prompts (user_id, system_prompt_id)
+            WHERE system_prompt_id IS NOT NULL;
+        -- у уже зарегистрированных пользователей лежат копии промптов по умолчанию, их убирает sync_system_prompts;
+        -- новые пользователи копий не получают
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS prompts_deduplicated BOOLEAN NOT NULL DEFAULT FALSE;
+        ALTER TABLE users ALTER COLUMN prompts_deduplicated SET DEFAULT TRUE;
+        CREATE INDEX IF NOT EXISTS users_prompts_not_deduplicated_idx ON users (telegram_id)
+            WHERE NOT prompts_deduplicated;
+    '''),
+]
+
+# произвольный ключ, чтобы несколько экземпляров бота не мигрировали базу одновременно
+MIGRATIONS_LOCK_KEY = 718298001
+
+
+async def apply_migrations(connection: asyncpg.Connection) -> List[int]:
+    applied = []
+    async with connection.transaction():
+        await connection.execute('SELECT pg_advisory_xact_lock($1)', MIGRATIONS_LOCK_KEY)
+        await connection.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        current = await connection.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            logging.info(f"Применяем миграцию {migration.version}: {migration.description}")
+            await connection.execute(migration.sql)
+            await connection.execute('''
+                INSERT INTO schema_migrations (version, description)
+                VALUES ($1, $2)
+            ''', migration.version, migration.description)
+            applied.append(migration.version)
+    return applied
+
+
+# Промпты по умолчанию задаются в конфиге и при каждом запуске переносятся в system_prompts.
+# Заодно у пользователей, зарегистрированных до миграции 5, копии этих промптов заменяются общими:
+# совпадающие копии удаляются, а для удаленных когда-то пользователем промптов ставится отметка hidden.
+async def sync_system_prompts(connection: asyncpg.Connection, prompts: List[str]):
+    async with connection.transaction():
+        await connection.execute('SELECT pg_advisory_xact_lock($1)', MIGRATIONS_LOCK_KEY)
+        await connection.execute('''
+            INSERT INTO system_prompts (prompt, position)
+            SELECT DISTINCT ON (p) p, n::int FROM unnest($1::text[]) WITH ORDINALITY AS t(p, n)
+            ORDER BY p, n
+            ON CONFLICT (prompt) DO UPDATE SET position = EXCLUDED.position
+        ''', prompts)
+        # правки убранных из конфига промптов остаются у пользователей как обычные промпты
+        await connection.execute('DELETE FROM system_prompts WHERE NOT (prompt = ANY($1::text[]))', prompts)
+        await connection.execute('DELETE FROM prompts WHERE hidden AND system_prompt_id IS NULL')
+
+        await connection.execute('''
+            INSERT INTO prompts (user_id, prompt, system_prompt_id, hidden)
+            SELECT u.telegram_id, s.prompt, s.id, TRUE
+            FROM users u CROSS JOIN system_prompts s
+            WHERE NOT u.prompts_deduplicated
+              AND NOT EXISTS (
+                  SELECT 1 FROM prompts p
+                  WHERE p.user_id = u.telegram_id AND p.system_prompt_id IS NULL AND p.prompt = s.prompt
+              )
+            ON CONFLICT DO NOTHING
+        ''')
+        deleted = await connection.execute('''
+            DELETE FROM prompts p
+            USING users u, system_prompts s
+            WHERE p.user_id = u.telegram_id AND NOT u.prompts_deduplicated
+              AND p.system_prompt_id IS NULL AND p.prompt = s.prompt
+        ''')
+        updated = await connection.execute('UPDATE users SET prompts_deduplicated = TRUE WHERE NOT prompts_deduplicated')
+    if updated != 'UPDATE 0':
+        logging.info(f"Копии промптов по умолчанию заменены общими: {deleted}, {updated}")
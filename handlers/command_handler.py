@@ -5,6 +5,7 @@ from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, LabeledPrice, PreCheckoutQuery
 
+import open_ai
 from FSM import FSMPrompt
 from database.db import Database
 from aiogram.handlers import PreCheckoutQueryHandler
@@ -15,6 +16,8 @@ router = Router()
 @router.message(Command(commands=['cancel']))
 async def cancel(message: Message, state: FSMContext):
     try:
+        # Прерываем запрос к нейросети, если он еще выполняется
+        open_ai.cancel_user_request(message.from_user.id)
         await message.reply("Команда отменена")
 
         # Проверка состояния и его очистка
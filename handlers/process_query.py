@@ -1,81 +1,224 @@
+import asyncio
 import logging
 
 from aiogram.exceptions import TelegramAPIError
-from aiogram.types import Message
+from aiogram.types import InputMediaPhoto, Message, PhotoSize
 
+import identification
 import open_ai
+from config import config
 from database.db import Database
+from handlers.streaming_reply import StreamingReply
+from models.reservation import Reservation
+from llm_scheduler import PRIORITY_PAID, PRIORITY_FREE, SchedulerOverloadedError
+from photo_cache import dhash, estimate_vision_tokens
 
 
-async def process_query(message: Message, db: Database, query: str):  # нет проверок, т.к. мы их делаем в мидлвари
+# платные пользователи (is_admin выставляется при оплате) обслуживаются в первую очередь
+async def get_priority(db: Database, user_id: int) -> int:
+    try:
+        return PRIORITY_PAID if await db.is_admin(user_id) else PRIORITY_FREE
+    except Exception as e:
+        logging.error(f"Ошибка при определении приоритета пользователя {user_id}: {e}")
+        return PRIORITY_FREE
+
+
+# запрос засчитывается до обращения к нейросети одним атомарным запросом к БД,
+# поэтому параллельные сообщения пользователя не могут превысить лимит
+async def reserve_request(message: Message, db: Database) -> Reservation | None:
+    try:
+        reservation = await db.reserve_request(message.from_user.id)
+    except Exception as e:
+        logging.error(f"Ошибка при резервировании запроса пользователя {message.from_user.id}: {e}")
+        await message.reply("Произошла ошибка при проверке лимита запросов. Попробуйте позже.")
+        return None
+    if reservation is None:
+        await message.reply("Вы исчерпали лимит запросов на сегодня.")
+    return reservation
+
+
+# ответ не доставлен - возвращаем зарезервированный запрос
+async def release_request(db: Database, user_id: int, reservation: Reservation):
+    try:
+        await db.release_request(user_id, reservation)
+    except Exception as e:
+        logging.error(f"Ошибка при возврате запроса пользователя {user_id}: {e}")
+
+
+async def report_requests(message: Message, reservation: Reservation):
+    try:
+        await message.answer(f"Всего запросов от вас за сегодня: {reservation.daily_requests}")
+    except TelegramAPIError as e:
+        logging.error(f"Ошибка при отправке информации о запросах пользователю: {e}")
+
+
+async def process_query(message: Message, db: Database, query: str):
+    reservation = await reserve_request(message, db)
+    if reservation is None:
+        return
+    delivered = False
+    try:
+        delivered = await _answer_query(message, db, query)
+    finally:
+        # запрос засчитывается, только если итоговый текст доставлен пользователю
+        if not delivered:
+            await release_request(db, message.from_user.id, reservation)
+    if delivered:
+        await report_requests(message, reservation)
+
+
+async def _answer_query(message: Message, db: Database, query: str) -> bool:
     user_id = message.from_user.id
+    streamer = StreamingReply(message) if config.openai_stream else None
     try:
-        reply = open_ai.get_openai_response(None, query)
+        priority = await get_priority(db, user_id)
+        if streamer:
+            await streamer.start()
+        reply = await open_ai.get_openai_response(None, query, user_id, priority,
+                                                  streamer.update if streamer else None)
         if not reply:
             raise ValueError("Некорректный ответ от OpenAI.")
+    except open_ai.RequestCancelledError:
+        if streamer:
+            await streamer.discard()
+        return False  # пользователь сам отменил запрос командой /cancel
+    except SchedulerOverloadedError:
+        if streamer:
+            await streamer.discard()
+        await message.reply("Сервис перегружен. Попробуйте через пару минут.")
+        return False
     except Exception as e:
         logging.error(f"Ошибка при получении ответа от OpenAI: {e}")
+        if streamer:
+            await streamer.discard()
         await message.reply("Произошла ошибка при обработке запроса. Попробуйте позже.")
-        return
+        return False
 
     try:
-        await message.reply(reply)
+        if streamer:
+            await streamer.finish(reply)
+        else:
+            await message.reply(reply)
     except TelegramAPIError as e:
         logging.error(f"Ошибка при отправке сообщения пользователю: {e}")
         await message.answer("Произошла ошибка при отправке сообщения. Попробуйте позже.")
-        return
+        return False
+
+    return True
 
+
+# Telegram хранит фото размерами 90/320/800/1280 по длинной стороне; с detail=low модель все равно
+# смотрит на 512x512, поэтому качаем наименьший размер, длинная сторона которого не меньше target
+def select_photo_size(sizes: list[PhotoSize], target: int) -> PhotoSize:
+    suitable = [size for size in sizes if max(size.width, size.height) >= target]
+    if suitable:
+        return min(suitable, key=lambda size: size.width * size.height)
+    return max(sizes, key=lambda size: size.width * size.height)
+
+
+# album - все сообщения альбома, если их собрал UserSerialMiddleware; тогда это один запрос к OpenAI
+# и засчитывается он один раз
+async def process_photo(message: Message, db: Database, prompt_text: str | None,
+                        album: list[Message] | None = None):
+    reservation = await reserve_request(message, db)
+    if reservation is None:
+        return
+    delivered = False
     try:
-        daily_requests = await db.increment_requests(user_id)
-        if daily_requests is None:
-            raise ValueError("Не удалось обновить количество запросов в базе данных.")
-        if isinstance(daily_requests, int):
-            await message.answer(f"Всего запросов от вас за сегодня: {daily_requests}")
-    except Exception as e:
-        logging.error(f"Ошибка при обновлении в БД количества запросов от пользователя {user_id}: {e}")
-        await message.answer("Произошла непредвиденная ошибка. Попробуйте позже.")
+        delivered = await _answer_photo(message, db, prompt_text, album)
+    finally:
+        if not delivered:
+            await release_request(db, message.from_user.id, reservation)
+    if delivered:
+        await report_requests(message, reservation)
+
 
-async def process_photo(message: Message, db: Database, prompt_text: str | None):
+async def _answer_photo(message: Message, db: Database, prompt_text: str | None,
+                        album: list[Message] | None) -> bool:
+    messages = album or [message]
+    # без пользовательского промпта фото распознаем и дополняем статьей из Википедии
+    use_wiki = identification.pipeline is not None and prompt_text is None
+    language = identification.pipeline.pick_language(message.from_user.language_code) if use_wiki else None
+    wiki_images = []
     try:
-        if message.caption and isinstance(message.caption, str):
+        # в альбоме подпись есть только у одного из сообщений
+        caption = next((m.caption for m in messages if m.caption and isinstance(m.caption, str)), None)
+        if caption:
             # Добавляем текст сообщения к prompt_text
-            prompt_text = f"{prompt_text} \n {message.caption}" if prompt_text else message.caption
+            prompt_text = f"{prompt_text} \n {caption}" if prompt_text else caption
+        # ответ со статьей зависит от раздела Википедии, поэтому для каждого языка кэшируется свой
+        cache_prompt = f"{prompt_text or ''} [wiki:{language}]" if use_wiki else prompt_text
 
-        if not message.photo:
+        photos = [select_photo_size(m.photo, config.photo_target_size) for m in messages if m.photo]
+        if not photos:
             raise ValueError("Сообщение не содержит фото.")
-        photo = message.photo[-1]
-        # Получение информации о файле
-        file_info = await message.bot.get_file(photo.file_id)
-        if not file_info:
-            raise ValueError("Получена неверная информация о файле {photo.file_id}")
-        file_path = file_info.file_path
-        if not file_path:
-            raise ValueError(f"Ошибка получения пути к файлу {photo.file_id}")
-        if not message.bot.token:
-            raise ValueError("Ошибка получения токена бота")
-        file_url = f'https://api.telegram.org/file/bot{message.bot.token}/{file_path}'
+        # пересланное или повторно отправленное фото (альбом) узнаем до скачивания
+        file_key = "|".join(photo.file_unique_id for photo in photos)
+        cached = open_ai.photo_cache.get_by_file(file_key, cache_prompt) if config.photo_cache_enabled else None
+        image_hash = None
+        if cached is None:
+            # Скачиваем фото в память через сессию бота
+            images = await asyncio.gather(*(message.bot.download(photo) for photo in photos))
+            if any(image is None for image in images):
+                raise ValueError(f"Не удалось скачать файлы {[photo.file_id for photo in photos]}")
+            file_urls = [open_ai.make_data_url(image.getvalue()) for image in images]
+            if config.photo_cache_enabled:
+                if len(images) == 1:  # перцептивный хэш считаем только для одиночных фото
+                    try:
+                        image_hash = await asyncio.to_thread(dhash, images[0].getvalue())
+                    except Exception as e:
+                        logging.error(f"Ошибка при вычислении хэша фото {photos[0].file_id}: {e}")
+                cached = open_ai.photo_cache.get_by_hash(image_hash, cache_prompt)
     except Exception as e:
         logging.error(f"Ошибка при получении информации о файле: {e}")
         await message.reply("Произошла ошибка при получении информации о файле. Попробуйте снова.")
-        return
+        return False
 
+    reply = None
+    if cached is not None:
+        reply, wiki_images = cached.response, list(cached.images)
     try:
-        reply = open_ai.get_openai_response(file_url, prompt_text)
-        if not reply:
-            raise ValueError("Некорректный ответ от OpenAI.")
+        if reply is None:
+            priority = await get_priority(db, message.from_user.id)
+            if use_wiki:
+                result = await identification.pipeline.identify(file_urls, prompt_text, message.from_user.id,
+                                                                priority, language)
+                reply = identification.format_reply(result)
+                if result.wiki is not None:
+                    wiki_images = result.wiki[3][:identification.MAX_IMAGES]
+            else:
+                reply = await open_ai.get_openai_response(None, prompt_text, message.from_user.id, priority,
+                                                          images=file_urls)
+            if not reply:
+                raise ValueError("Некорректный ответ от OpenAI.")
+            if config.photo_cache_enabled:
+                open_ai.photo_cache.put(file_key, image_hash, cache_prompt, reply,
+                                        sum(estimate_vision_tokens(photo.width, photo.height, config.photo_detail)
+                                            for photo in photos),
+                                        wiki_images)
+    except open_ai.RequestCancelledError:
+        return False  # пользователь сам отменил запрос командой /cancel
+    except SchedulerOverloadedError:
+        await message.reply("Сервис перегружен. Попробуйте через пару минут.")
+        return False
     except Exception as e:
         logging.error(f"Ошибка при получении ответа от OpenAI: {e}")
         await message.reply("Произошла ошибка при обработке запроса. Попробуйте снова.")
-        return
+        return False
 
     try:
         await message.reply(reply)
-        user_id = message.from_user.id
-        daily_requests = await db.increment_requests(user_id)
-        if daily_requests is None:
-            raise ValueError("Не удалось обновить количество запросов в базе данных.")
-        if isinstance(daily_requests, int):
-            await message.answer(f"Всего запросов от вас за сегодня: {daily_requests}")
-    except Exception as e:
-        logging.error(f"Ошибка при отправке ответа и информации о запросах пользователю: {e}")
-        await message.answer("Произошла ошибка при отправке ответа. Попробуйте позже.")
\ No newline at end of file
+    except TelegramAPIError as e:
+        logging.error(f"Ошибка при отправке ответа пользователю: {e}")
+        await message.answer("Произошла ошибка при отправке ответа. Попробуйте позже.")
+        return False
+
+    if wiki_images:
+        try:
+            if len(wiki_images) == 1:  # альбом из одной картинки Telegram не принимает
+                await message.answer_photo(wiki_images[0])
+            else:
+                await message.answer_media_group([InputMediaPhoto(media=url) for url in wiki_images])
+        except TelegramAPIError as e:
+            logging.info(f"Не удалось отправить картинки из Википедии: {e}")
+    return True
@@ -0,0 +1,94 @@
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from cachetools import TTLCache
+
+from callbacks.factory import MyCallbackFactory
+from config import config
+from database.db import Database
+from models.prompt import Prompt
+
+# подпись кнопки промпта в зависимости от того, что с ним собираются делать
+BUTTON_PREFIXES = {
+    "use": "",
+    "edit": "✏️ ",
+    "delete": "❌ ",
+}
+
+
+class CatalogEntry:
+    __slots__ = ('prompts', 'by_id', 'markups')
+
+    def __init__(self, prompts: List[Prompt]):
+        self.prompts = prompts
+        self.by_id: Dict[int, Prompt] = {prompt.id: prompt for prompt in prompts}
+        self.markups: Dict[str, InlineKeyboardMarkup] = {}  # клавиатуры строятся при первом запросе
+
+
+class PromptCatalog:
+    """Промпты пользователя и готовые клавиатуры к ним для /prompts, /edit и /delete.
+
+    Записи живут ttl секунд, самые давние вытесняются при переполнении. Database сбрасывает
+    запись пользователя при добавлении, изменении и удалении его промптов."""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.entries = TTLCache(maxsize=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def _get_entry(self, db: Database, telegram_id: int) -> Optional[CatalogEntry]:
+        entry = self.entries.get(telegram_id)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        prompts = await db.get_prompts_by_user(telegram_id)
+        if prompts is None:
+            return None  # пул не готов - такое не кэшируем
+        entry = CatalogEntry(prompts)
+        self.entries[telegram_id] = entry
+        return entry
+
+    async def get_prompts(self, db: Database, telegram_id: int) -> Optional[List[Prompt]]:
+        entry = await self._get_entry(db, telegram_id)
+        return entry.prompts if entry is not None else None
+
+    async def get_prompt(self, db: Database, telegram_id: int, prompt_id: int) -> Optional[Prompt]:
+        entry = await self._get_entry(db, telegram_id)
+        prompt = entry.by_id.get(prompt_id) if entry is not None else None
+        if prompt is None:
+            # кнопка из старого сообщения - промпта в текущем списке может уже не быть
+            prompt = await db.get_prompt_by_id(prompt_id)
+        return prompt
+
+    async def get_markup(self, db: Database, telegram_id: int, action: str) -> Optional[InlineKeyboardMarkup]:
+        entry = await self._get_entry(db, telegram_id)
+        if entry is None:
+            raise ValueError("Ошибка при получении промптов из базы данных.")
+        if not entry.prompts:
+            return None
+        markup = entry.markups.get(action)
+        if markup is None:
+            keyboard = InlineKeyboardBuilder()
+            for prompt in entry.prompts:
+                cb_data = MyCallbackFactory(action=action, prompt_id=prompt.id)
+                keyboard.button(text=BUTTON_PREFIXES[action] + prompt.prompt, callback_data=cb_data.pack())
+            keyboard.adjust(1)
+            markup = entry.markups[action] = keyboard.as_markup()
+        return markup
+
+    def invalidate(self, telegram_id: int):
+        self.entries.pop(telegram_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+        }
+
+
+prompt_catalog = PromptCatalog(config.prompt_cache_size, config.prompt_cache_ttl)
@@ -3,7 +3,6 @@ import logging
 from aiogram import Router, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import config
 
@@ -13,6 +12,7 @@ from filters.admin_filter import IsAdminFilter
 
 from filters.prompt_filter import GoodPromptFilter, CommandFilter
 from handlers.process_query import *
+from handlers.prompt_catalog import prompt_catalog
 
 router = Router()
 
@@ -25,19 +25,10 @@ async def list_prompts(message: Message, db: Database, state: FSMContext):
         if current_state is not None:
             await state.clear()  # чтобы свободно перейти сюда из любого другого состояния
         user_id = message.from_user.id
-        prompts = await db.get_prompts_by_user(user_id)
-        if prompts is None:
-            raise ValueError("Ошибка при получении промптов из базы данных.")
-
-        if prompts:
-            keyboard = InlineKeyboardBuilder()
-            for prompt in prompts:
-                if not hasattr(prompt, 'id') or not hasattr(prompt, 'prompt'):
-                    raise AttributeError(f"У промпта отсутствуют необходимые атрибуты: {prompt}")
-                cb_data = MyCallbackFactory(action="use", prompt_id=prompt.id)
-                keyboard.button(text=prompt.prompt, callback_data=cb_data.pack())
-            keyboard.adjust(1)
-            await message.reply("Вот ваши промпты:", reply_markup=keyboard.as_markup())
+        # список и клавиатура берутся из кэша, в БД идем только после изменений
+        markup = await prompt_catalog.get_markup(db, user_id, "use")
+        if markup:
+            await message.reply("Вот ваши промпты:", reply_markup=markup)
         else:
             await message.reply("У вас нет ни одного промпта. Создайте их с помощью команды /add.")
     except AttributeError as e:
@@ -72,9 +63,10 @@ async def add_prompt(message: Message, db: Database, state: FSMContext):
         user_id = message.from_user.id
 
         try:
-            current_prompts_count = await db.get_user_prompts_count(user_id)
-            if current_prompts_count is None:
+            prompts = await prompt_catalog.get_prompts(db, user_id)
+            if prompts is None:
                 raise ValueError("Ошибка при получении количества промптов из базы данных.")
+            current_prompts_count = len(prompts)
         except Exception as e:
             logging.error(f"Ошибка при получении количества промптов из базы данных: {e}")
             await message.reply("Произошла ошибка при получении данных. Попробуйте позже.")
@@ -157,26 +149,17 @@ async def delete_prompt(message: Message, db: Database, state: FSMContext):
             await state.clear()  # чтобы свободно перейти сюда из любого другого состояния, т.е. приоритет любой команды /... выше, чем все предыдущее
         user_id = message.from_user.id
 
-        # Получение промптов пользователя из базы данных
+        # Получение промптов пользователя
         try:
-            prompts = await db.get_prompts_by_user(user_id)
-            if prompts is None:
-                raise ValueError("Ошибка при получении промптов из базы данных.")
+            markup = await prompt_catalog.get_markup(db, user_id, "delete")
         except Exception as e:
             logging.error(f"Ошибка при получении промптов из базы данных для пользователя {user_id}: {e}")
             await message.reply("Произошла ошибка при получении данных. Попробуйте позже.")
             return
 
-        if prompts:
-            keyboard = InlineKeyboardBuilder()
-            for prompt in prompts:
-                if not hasattr(prompt, 'id') or not hasattr(prompt, 'prompt'):
-                    raise AttributeError(f"У промпта отсутствуют необходимые атрибуты: {prompt}")
-                cb_data = MyCallbackFactory(action="delete", prompt_id=prompt.id)
-                keyboard.button(text="❌ " + prompt.prompt, callback_data=cb_data.pack())
-            keyboard.adjust(1)
+        if markup:
             await message.reply("Выберите промпт для удаления или отмените операцию командой /cancel",
-                                reply_markup=keyboard.as_markup())
+                                reply_markup=markup)
         else:
             await message.reply("У вас нет промптов для удаления.")
     except Exception as e:
@@ -193,26 +176,17 @@ async def edit_prompt(message: Message, db: Database, state: FSMContext):
             await state.clear()  # чтобы свободно перейти сюда из любого другого состояния
 
         user_id = message.from_user.id
-        # Получение промптов пользователя из базы данных
+        # Получение промптов пользователя
         try:
-            prompts = await db.get_prompts_by_user(user_id)
-            if prompts is None:
-                raise ValueError("Ошибка при получении промптов из базы данных.")
+            markup = await prompt_catalog.get_markup(db, user_id, "edit")
         except Exception as e:
             logging.error(f"Ошибка при получении промптов из базы данных для пользователя {user_id}: {e}")
             await message.reply("Произошла ошибка при получении данных. Попробуйте позже.")
             return
 
-        if prompts:
-            keyboard = InlineKeyboardBuilder()
-            for prompt in prompts:
-                if not hasattr(prompt, 'id') or not hasattr(prompt, 'prompt'):
-                    raise AttributeError(f"У промпта отсутствуют необходимые атрибуты: {prompt}")
-                cb_data = MyCallbackFactory(action="edit", prompt_id=prompt.id)
-                keyboard.button(text="✏️ " + prompt.prompt, callback_data=cb_data.pack())
-            keyboard.adjust(1)
+        if markup:
             await message.reply("Выберите промпт для редактирования или отмените операцию командой /cancel",
-                                reply_markup=keyboard.as_markup())
+                                reply_markup=markup)
         else:
             await message.reply("У вас нет промптов для редактирования.")
     except Exception as e:
@@ -230,9 +204,9 @@ async def edit_prompt(callback_query: types.CallbackQuery, callback_data: MyCall
 
         prompt_id = callback_data.prompt_id
 
-        # Получение промпта по id из базы данных
+        # Получение промпта по id: пользователь только что видел его в списке, так что он в кэше
         try:
-            prompt = await db.get_prompt_by_id(prompt_id)
+            prompt = await prompt_catalog.get_prompt(db, callback_query.from_user.id, prompt_id)
             if prompt is None:
                 raise ValueError("Ошибка при получении промпта из базы данных.")
         except Exception as e:
@@ -299,7 +273,7 @@ async def get_edited_prompt(message: types.Message, db: Database, state: FSMCont
 
         # Редактирование промпта в базе данных
         try:
-            await db.edit_user_prompt(prompt_id, prompt_text)
+            await db.edit_user_prompt(prompt_id, prompt_text, message.from_user.id)
         except Exception as e:
             logging.error(f"Ошибка при редактировании промпта с id {prompt_id}: {e}")
             await message.reply("Произошла ошибка при редактировании промпта. Попробуйте позже.")
@@ -355,9 +329,9 @@ async def use_prompt(callback_query: types.CallbackQuery, callback_data: MyCallb
 
         prompt_id = callback_data.prompt_id
 
-        # Получение промпта по id из базы данных
+        # Получение промпта по id: пользователь только что видел его в списке, так что он в кэше
         try:
-            prompt = await db.get_prompt_by_id(prompt_id)
+            prompt = await prompt_catalog.get_prompt(db, callback_query.from_user.id, prompt_id)
             if not prompt:
                 raise ValueError("Промпт не найден в базе данных.")
         except Exception as e:
@@ -406,7 +380,7 @@ async def delete_prompt(callback_query: types.CallbackQuery, callback_data: MyCa
 
         prompt_id = callback_data.prompt_id
 
-        if await db.delete_user_prompt(prompt_id):
+        if await db.delete_user_prompt(prompt_id, callback_query.from_user.id):
             await callback_query.answer(f"Промпт удален")
         else:
             await callback_query.answer(f"Ошибка при удалении промпта. Попробуйте позже.")
@@ -423,7 +397,8 @@ async def delete_prompt(callback_query: types.CallbackQuery, callback_data: MyCa
 # в этом случае текст может быть короче или даже состоять из точки или дефиса
 # добавляю обработку фото
 @router.message(StateFilter(FSMPrompt.using), (F.text.len() <= config.max_query_len) | F.photo)
-async def add_prompt_to_query(message: Message, db: Database, state: FSMContext):
+async def add_prompt_to_query(message: Message, db: Database, state: FSMContext,
+                              album: list[Message] | None = None):
     try:
         # Получение данных состояния пользователя
         user_data = await state.get_data()
@@ -442,7 +417,7 @@ async def add_prompt_to_query(message: Message, db: Database, state: FSMContext)
                 await message.reply("Произошла ошибка при обработке текста запроса. Попробуйте позже.")
         elif message.photo:
             try:
-                await process_photo(message, db, prompt_text)
+                await process_photo(message, db, prompt_text, album)
             except Exception as e:
                 logging.error(f"Ошибка при обработке фото: {e}")
                 await message.reply("Произошла ошибка при обработке фото. Попробуйте позже.")
@@ -463,9 +438,9 @@ async def add_prompt_to_query(message: Message, db: Database, state: FSMContext)
 
 
 @router.message(F.photo)
-async def send_photo(message: Message, db: Database):
+async def send_photo(message: Message, db: Database, album: list[Message] | None = None):
     try:
-        await process_photo(message, db, None)
+        await process_photo(message, db, None, album)
     except Exception as e:
         logging.error(f"Ошибка при обработке фото: {e}")
         await message.reply("Произошла ошибка при обработке фото. Попробуйте позже.")
@@ -495,6 +470,26 @@ async def admin(message: Message, db: Database):
             await message.answer("Топ-10 пользователей по количеству запросов за все время:\n" + table)
         else:
             await message.answer("Не удалось получить статистику")
+
+        await message.answer("Очередь к OpenAI:\n" + make_scheduler_table(open_ai.scheduler.stats()))
+
+        cache_stats = open_ai.response_cache.stats()
+        await message.answer(f"Кэш ответов: попаданий {cache_stats['local_hits']} (локально) + "
+                             f"{cache_stats['shared_hits']} (общий), промахов {cache_stats['misses']}, "
+                             f"доля попаданий {cache_stats['hit_ratio']:.0%}, "
+                             f"сэкономлено {cache_stats['saved_seconds']:.0f} с ожидания")
+        photo_stats = open_ai.photo_cache.stats()
+        await message.answer(f"Кэш фото: попаданий {photo_stats['file_hits']} (по файлу) + "
+                             f"{photo_stats['hash_hits']} (по хэшу), промахов {photo_stats['misses']}, "
+                             f"доля попаданий {photo_stats['hit_ratio']:.0%}, "
+                             f"сэкономлено ~{photo_stats['saved_tokens']} токенов изображений")
+        catalog_stats = prompt_catalog.stats()
+        await message.answer(f"Кэш промптов: пользователей {catalog_stats['entries']}, "
+                             f"доля попаданий {catalog_stats['hit_ratio']:.0%}")
+        id_stats = identification.pipeline.stats() if identification.pipeline is not None else {'runs': 0}
+        if id_stats['runs']:
+            await message.answer(f"Распознавание фото ({id_stats['runs']} шт.), среднее время этапов: "
+                                 + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in id_stats['avg'].items()))
     except Exception as e:
         logging.error(f"Ошибка при получении статистики по запросам: {e}")
         await message.answer("Произошла ошибка при получении статистики.")
@@ -513,6 +508,15 @@ def make_table(top_users, order_by: str = 'daily_requests'):
     return table_divider + table_header + table_divider + table_body + table_divider
 
 
+def make_scheduler_table(stats: dict) -> str:
+    text = (f"В работе: {stats['in_flight']}, токенов за минуту: {stats['tokens_last_minute']}\n"
+            "<b>Tier</b> | <b>Queue</b> | <b>Admitted</b> | <b>Rejected</b> | <b>Avg/p95/max wait, s</b>\n")
+    for tier, s in stats['tiers'].items():
+        text += (f"{tier} | {stats['queue_depth'][tier]} | {s['admitted']} | {s['rejected']} | "
+                 f"{s['avg_wait']:.2f}/{s['p95_wait']:.2f}/{s['max_wait']:.2f}\n")
+    return text
+
+
 @router.message(Command(commands=['admin']))
 async def admin(message: Message):
     try:
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from config import config
+
+MAX_MESSAGE_LEN = 4096  # ограничение Telegram на длину сообщения
+PLACEHOLDER = "⏳"
+NOT_MODIFIED = "message is not modified"  # текст уже такой же, как в последней правке
+
+
+class StreamingReply:
+    """Показывает ответ нейросети по мере генерации, редактируя сообщение-заглушку.
+
+    Правки склеиваются: не чаще раза в stream_edit_interval секунд и не меньше
+    stream_edit_min_chars новых символов, чтобы не упираться в лимиты Telegram."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.placeholder: Message | None = None
+        self.last_edit = 0.0
+        self.last_len = 0
+
+    async def start(self):
+        self.placeholder = await self.message.reply(PLACEHOLDER)
+        self.last_edit = time.monotonic()
+
+    async def update(self, text: str):
+        if self.placeholder is None:
+            return
+        now = time.monotonic()
+        if now - self.last_edit < config.stream_edit_interval:
+            return
+        if len(text) - self.last_len < config.stream_edit_min_chars:
+            return
+        self.last_edit = now
+        self.last_len = len(text)
+        try:
+            # промежуточный текст может содержать незакрытую разметку, поэтому без parse_mode
+            await self.placeholder.edit_text(text[:MAX_MESSAGE_LEN], parse_mode=None)
+        except TelegramRetryAfter as e:
+            self.last_edit = now + e.retry_after
+            logging.warning(f"Telegram просит подождать {e.retry_after} с перед редактированием сообщения")
+        except TelegramAPIError as e:
+            # промежуточная правка не обязательна: сеть или сервер Telegram не должны прерывать генерацию
+            logging.info(f"Не удалось отредактировать сообщение: {e}")
+
+    async def finish(self, text: str):
+        chunks = [text[i:i + MAX_MESSAGE_LEN] for i in range(0, len(text), MAX_MESSAGE_LEN)]
+        if self.placeholder is None:
+            await self.message.reply(chunks[0])
+        else:
+            await self._edit_final(chunks[0])
+        for chunk in chunks[1:]:
+            await self.message.answer(chunk)
+
+    async def _edit_final(self, text: str):
+        try:
+            await self._edit_formatted(text)
+        except TelegramRetryAfter as e:
+            # итоговый текст терять нельзя, поэтому ждем и пробуем еще раз
+            await asyncio.sleep(e.retry_after)
+            await self._edit_formatted(text)
+
+    async def _edit_formatted(self, text: str):
+        try:
+            await self.placeholder.edit_text(text)
+        except TelegramBadRequest as e:
+            if NOT_MODIFIED in str(e):
+                return
+            # разметка ответа не разобралась - показываем как есть; без разметки текст
+            # может совпасть с последней промежуточной правкой, тогда пользователь его уже видит
+            try:
+                await self.placeholder.edit_text(text, parse_mode=None)
+            except TelegramBadRequest as e:
+                if NOT_MODIFIED not in str(e):
+                    raise
+
+    async def discard(self):
+        if self.placeholder is None:
+            return
+        try:
+            await self.placeholder.delete()
+        except TelegramAPIError as e:
+            logging.info(f"Не удалось удалить сообщение-заглушку: {e}")
+        self.placeholder = None
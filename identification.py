@@ -0,0 +1,177 @@
+import asyncio
+import html
+import logging
+import re
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import open_ai
+from config import config
+from llm_scheduler import PRIORITY_FREE
+from wiki import KINGDOM_EXTRACTORS, WikiEngine
+from wiki_cache import WikiCache
+
+# строка кандидата в ответе модели: "КАНДИДАТ: Quercus robur | Plantae"
+CANDIDATE_RE = re.compile(r"^\s*КАНДИДАТ\s*:\s*(.+?)\s*\|\s*(.+?)\s*$", re.IGNORECASE | re.MULTILINE)
+SEPARATOR_RE = re.compile(r"^\s*---\s*$", re.MULTILINE)
+
+INSTRUCTION = (
+    "Определи, какой организм изображен на фото. Сначала перечисли до {top_k} вариантов, "
+    "начиная с самого вероятного, каждый отдельной строкой в формате\n"
+    "КАНДИДАТ: <научное латинское название> | <царство по-латыни: Plantae, Animalia, Fungi и т.п.>\n"
+    "Затем напиши строку --- и после нее ответ для пользователя."
+)
+
+MAX_SUMMARY_LEN = 1000
+MAX_IMAGES = 3
+
+
+class Identification(NamedTuple):
+    answer: str  # ответ модели без служебных строк
+    candidates: List[Tuple[str, str]]  # (латинское название, царство) по убыванию вероятности
+    wiki: Optional[Tuple[str, str, str, List[str]]]  # (название, ссылка, описание, картинки)
+    timings: Dict[str, float]
+
+
+def parse_candidates(text: str, top_k: int) -> List[Tuple[str, str]]:
+    head = SEPARATOR_RE.split(text, maxsplit=1)[0]
+    return [(name, kingdom) for name, kingdom in CANDIDATE_RE.findall(head)][:top_k]
+
+
+def strip_candidates(text: str) -> str:
+    parts = SEPARATOR_RE.split(text, maxsplit=1)
+    if len(parts) == 2:
+        return parts[1].strip()
+    return CANDIDATE_RE.sub("", text).strip()  # модель забыла разделитель
+
+
+class IdentificationPipeline:
+    """Распознавание фото нейросетью с проверкой по Википедии.
+
+    Ответ модели читается потоком (если включен OPENAI_STREAM): как только дописана строка
+    очередного кандидата, для него сразу запускается поиск в Википедии, не дожидаясь конца ответа. В итоговый
+    ответ попадает статья самого вероятного кандидата, для которой нашлось нужное царство.
+    Раздел Википедии выбирается по языку пользователя, если он есть среди languages
+    и для него зарегистрирован разборщик царства."""
+
+    def __init__(self, engine: WikiEngine, language: str, top_k: int, languages: List[str] = ()):
+        self.engine = engine
+        self.language = language  # раздел по умолчанию
+        self.languages = {lang for lang in languages if lang in KINGDOM_EXTRACTORS} | {language}
+        self.top_k = top_k
+        # суммарная длительность этапов и сколько раз этап был, для /admin
+        self.stage_totals: Dict[str, float] = {}
+        self.stage_counts: Dict[str, int] = {}
+        self.runs = 0
+
+    def pick_language(self, language_code: str | None) -> str:
+        # Telegram присылает IETF-тег вроде "en-US", а разделы Википедии называются по первой части
+        if language_code:
+            language = language_code.split('-')[0].lower()
+            if language in self.languages:
+                return language
+        return self.language
+
+    async def identify(self, images: List[str], question: str | None, user_id: int = None,
+                       priority: int = PRIORITY_FREE, language: str | None = None) -> Identification:
+        language = language or self.language
+        start = time.monotonic()
+        timings: Dict[str, float] = {}
+        candidates: List[Tuple[str, str]] = []
+        lookups: List[asyncio.Task] = []
+
+        def start_lookups(text: str):
+            for name, kingdom in parse_candidates(text, self.top_k)[len(candidates):]:
+                if not lookups:
+                    timings['first_candidate'] = time.monotonic() - start
+                candidates.append((name, kingdom))
+                lookups.append(asyncio.create_task(self.engine.get_wiki(language, name, kingdom)))
+
+        async def on_update(text: str):
+            # последняя строка может быть еще не дописана
+            start_lookups(text[:text.rfind("\n") + 1])
+
+        prompt = INSTRUCTION.format(top_k=self.top_k)
+        if question:
+            prompt = f"{prompt}\nВопрос пользователя: {question}"
+        try:
+            text = await open_ai.get_openai_response(None, prompt, user_id, priority,
+                                                     on_update if config.openai_stream else None, images=images)
+            timings['vision'] = time.monotonic() - start
+            start_lookups(text)  # без потока или из кэша ответ приходит целиком
+
+            wiki_start = time.monotonic()
+            wiki = await self._first_match(lookups, candidates)
+            timings['wiki_wait'] = time.monotonic() - wiki_start  # сколько ждали Википедию после модели
+        finally:
+            for task in lookups:
+                task.cancel()
+            await asyncio.gather(*lookups, return_exceptions=True)
+        timings['total'] = time.monotonic() - start
+
+        self._record(timings)
+        logging.info(f"Распознавание фото пользователя {user_id}: "
+                     + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in timings.items()))
+        return Identification(strip_candidates(text) or text, candidates, wiki, timings)
+
+    @staticmethod
+    async def _first_match(lookups: List[asyncio.Task], candidates: List[Tuple[str, str]]):
+        # поиски идут параллельно, но предпочтение отдаем более вероятному кандидату
+        for task, (name, kingdom) in zip(lookups, candidates):
+            try:
+                result = await task
+            except Exception as e:
+                logging.info(f"Ошибка при поиске {name} ({kingdom}) в Википедии: {e}")
+                continue
+            if result is not None:
+                return result
+        return None
+
+    def _record(self, timings: Dict[str, float]):
+        self.runs += 1
+        for stage, seconds in timings.items():
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+            self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            'runs': self.runs,
+            'avg': {stage: total / self.stage_counts[stage] for stage, total in self.stage_totals.items()},
+        }
+
+
+# ответ уходит с parse_mode HTML, поэтому текст модели экранируется так же, как статья
+def format_reply(result: Identification) -> str:
+    answer = html.escape(result.answer, quote=False)
+    if result.wiki is None:
+        return answer
+    title, url, summary, _ = result.wiki
+    if len(summary) > MAX_SUMMARY_LEN:
+        summary = summary[:MAX_SUMMARY_LEN].rsplit(" ", 1)[0] + "…"
+    return (f"{answer}\n\n<b>{html.escape(title)}</b>\n{html.escape(summary)}\n"
+            f'<a href="{html.escape(url)}">Статья в Википедии</a>')
+
+
+# создаются в startup() только при WIKI_ENABLED, чтобы импорт модуля не открывал файл кэша
+wiki_engine: Optional[WikiEngine] = None
+pipeline: Optional[IdentificationPipeline] = None
+
+
+def init():
+    global wiki_engine, pipeline
+    if pipeline is not None:
+        return
+    wiki_engine = WikiEngine(
+        max_concurrency=config.wiki_max_concurrency,
+        timeout=config.wiki_timeout,
+        cache=WikiCache(config.wiki_cache_path, config.wiki_cache_size, config.wiki_cache_revalidate),
+        thumb_width=config.wiki_thumb_width,
+    )
+    pipeline = IdentificationPipeline(wiki_engine, config.wiki_language, config.wiki_top_k, config.wiki_languages)
+
+
+async def close():
+    global wiki_engine, pipeline
+    if wiki_engine is not None:
+        await wiki_engine.close()
+    wiki_engine = pipeline = None
@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+
+# Приоритетные полосы: чем меньше число, тем раньше запрос будет допущен к OpenAI
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+TIER_NAMES = {PRIORITY_PAID: 'paid', PRIORITY_FREE: 'free'}
+
+
+class SchedulerOverloadedError(Exception):
+    """Очередь к OpenAI переполнена, запрос не допущен."""
+
+
+class _TierStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: deque = deque(maxlen=1000)  # для оценки перцентилей
+
+    def record_wait(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def p95_wait(self) -> float:
+        if not self.recent_waits:
+            return 0.0
+        waits = sorted(self.recent_waits)
+        return waits[min(len(waits) - 1, math.ceil(len(waits) * 0.95) - 1)]
+
+
+class LLMScheduler:
+    """Допускает запросы к OpenAI с учетом общего лимита параллельности,
+    бюджета токенов в минуту и приоритета платных пользователей."""
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int, max_queue_size: int):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue_size = max_queue_size
+
+        self._in_flight = 0
+        self._queue: list = []  # куча из (priority, seq, tokens, future)
+        self._seq = itertools.count()
+        self._spent: deque = deque()  # (timestamp, tokens) за последнюю минуту
+        self._spent_tokens = 0
+        self._wakeup: asyncio.TimerHandle | None = None
+        self._stats = {priority: _TierStats() for priority in TIER_NAMES}
+
+    def _expire_spent(self, now: float):
+        while self._spent and now - self._spent[0][0] >= 60:
+            _, tokens = self._spent.popleft()
+            self._spent_tokens -= tokens
+
+    def _fits_budget(self, tokens: int) -> bool:
+        if not self.tokens_per_minute:
+            return True
+        # запрос крупнее всего бюджета пропускаем, когда окно пустое, иначе он не пройдет никогда
+        return self._spent_tokens + tokens <= self.tokens_per_minute or self._spent_tokens == 0
+
+    def _can_admit(self, tokens: int) -> bool:
+        return self._in_flight < self.max_concurrency and self._fits_budget(tokens)
+
+    def _admit(self, tokens: int, now: float):
+        self._in_flight += 1
+        if self.tokens_per_minute:
+            self._spent.append((now, tokens))
+            self._spent_tokens += tokens
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._expire_spent(now)
+        while self._queue:
+            priority, _, tokens, future = self._queue[0]
+            if future.done():  # ожидающий был отменен
+                heapq.heappop(self._queue)
+                continue
+            if not self._can_admit(tokens):
+                break
+            heapq.heappop(self._queue)
+            self._admit(tokens, now)
+            future.set_result(None)
+
+        # ждем, пока из окна выйдут старые токены
+        if self._queue and self._in_flight < self.max_concurrency and self._spent and self._wakeup is None:
+            delay = max(60 - (now - self._spent[0][0]), 0.01)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    async def acquire(self, priority: int, tokens: int):
+        stats = self._stats[priority]
+        start = time.monotonic()
+        self._expire_spent(start)
+
+        if not self._queue and self._can_admit(tokens):
+            self._admit(tokens, start)
+            stats.record_wait(0.0)
+            return
+
+        depth = sum(1 for *_, future in self._queue if not future.done())
+        if depth >= self.max_queue_size:
+            stats.rejected += 1
+            logging.warning(f"Очередь к OpenAI переполнена ({depth}), запрос отклонен")
+            raise SchedulerOverloadedError("Очередь запросов переполнена")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # слот уже был выдан, но забрать его не успели
+                self.release()
+            raise
+        stats.record_wait(time.monotonic() - start)
+
+    def release(self):
+        self._in_flight -= 1
+        self._dispatch()
+
+    def slot(self, priority: int, tokens: int) -> '_Slot':
+        return _Slot(self, priority, tokens)
+
+    def queue_depth(self) -> dict:
+        depth = {name: 0 for name in TIER_NAMES.values()}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth[TIER_NAMES[priority]] += 1
+        return depth
+
+    def stats(self) -> dict:
+        tiers = {}
+        for priority, name in TIER_NAMES.items():
+            s = self._stats[priority]
+            tiers[name] = {
+                'admitted': s.admitted,
+                'rejected': s.rejected,
+                'avg_wait': s.total_wait / s.admitted if s.admitted else 0.0,
+                'p95_wait': s.p95_wait(),
+                'max_wait': s.max_wait,
+            }
+        return {
+            'in_flight': self._in_flight,
+            'tokens_last_minute': self._spent_tokens,
+            'queue_depth': self.queue_depth(),
+            'tiers': tiers,
+        }
+
+
+class _Slot:
+    def __init__(self, scheduler: LLMScheduler, priority: int, tokens: int):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tokens = tokens
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.priority, self.tokens)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
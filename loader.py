@@ -1,8 +1,11 @@
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.memory import MemoryStorage
 from config import config
+from database.fsm_storage import PostgresStorage
 
 
 bot = Bot(token=config.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+# при нескольких репликах состояние диалога должно быть общим, иначе достаточно памяти процесса
+dp = Dispatcher(storage=PostgresStorage() if config.shared_state else MemoryStorage())
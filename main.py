@@ -3,16 +3,24 @@ import logging
 
 from loader import dp, bot
 from aiogram.types import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from cachetools import TTLCache
 
-from database.db import Database
+import identification
+import open_ai
+from database.db import Database, LIMIT_RESET_CHANNEL, PROMPTS_CHANGED_CHANNEL
+from database.fsm_storage import PostgresStorage
+from database.ledger import QuotaLedger
 from handlers import command_handler, prompt_handler
+from handlers.prompt_catalog import prompt_catalog
 from config import config
 
 from middlewares.database_middleware import DatabaseMiddleware
 from middlewares.throttling_middleware import ThrottlingMiddleware
+from middlewares.user_serial_middleware import UserSerialMiddleware
 
-from time_delta import get_seconds_to_midnight
+from time_delta import get_seconds_to_midnight, get_today
 from logging.handlers import TimedRotatingFileHandler
 
 # Настройка обработчика логов с ротацией по времени
@@ -34,9 +42,25 @@ logging.basicConfig(
     handlers=[handler]
 )
 
-# список тех, кто уже превысил суточный лимит
+# список тех, кто уже превысил суточный лимит; ключ (telegram_id, дата), поэтому очистка в полночь не гоняется с проверками
 cache_limit = TTLCache(config.max_cache_size, get_seconds_to_midnight())
 
+# после оплаты на любой реплике снимаем отметку об исчерпанном лимите и здесь
+def on_limit_reset(connection, pid, channel, payload):
+    try:
+        cache_limit.pop((int(payload), get_today()), None)
+    except ValueError as e:
+        logging.error(f"Некорректное уведомление о снятии лимита: {payload} ({e})")
+
+
+# промпты пользователя поменялись на какой-то из реплик
+def on_prompts_changed(connection, pid, channel, payload):
+    try:
+        prompt_catalog.invalidate(int(payload))
+    except ValueError as e:
+        logging.error(f"Некорректное уведомление об изменении промптов: {payload} ({e})")
+
+
 # Глобальные переменные для хранения БД и задачи сброса
 db: Database
 reset_task: asyncio.Task
@@ -46,10 +70,14 @@ async def reset_tasks():
     while True:
         try:
             await asyncio.sleep(get_seconds_to_midnight())  # спать до полуночи
-            if db is not None:
-                await db.reset_daily_requests()
+            # счетчики в БД сбрасываются лениво по requests_date, здесь только освобождаем память
             cache_limit.clear()
+            if db is not None and db.ledger is not None:
+                db.ledger.evict_stale()
             logging.info("Почистили кэш")
+            await open_ai.response_cache.prune()
+            if config.shared_state and db is not None:
+                await db.prune_fsm_storage()
         except Exception as e:
             logging.error(f"Произошла ошибка в reset_tasks: {e}", exc_info=True)
         finally:
@@ -59,11 +87,41 @@ async def reset_tasks():
 async def startup():
     global db, reset_task
     try:
-        db = Database(config.database_url)
+        db = Database(
+            config.database_url,
+            min_size=config.db_pool_min_size,
+            max_size=config.db_pool_max_size,
+            max_inactive_connection_lifetime=config.db_max_inactive_lifetime,
+            statement_cache_size=config.db_statement_cache_size,
+            statement_timeout=config.db_statement_timeout,
+        )
         await db.create_pool()  # Асинхронная инициализация пула соединений
         logging.info("Создали пул")
         await db.init_db()
         logging.info("База данных успешно инициализирована")
+        db.limit_cache = cache_limit  # отказ в резерве запроса сразу отмечается для мидлвари
+
+        if isinstance(dp.storage, PostgresStorage):
+            dp.storage.attach_db(db)  # состояния FSM общие для всех реплик
+        db.prompt_catalog = prompt_catalog
+        if config.shared_state:
+            # изменения, сделанные другими репликами, приходят через LISTEN/NOTIFY
+            await db.listen(LIMIT_RESET_CHANNEL, on_limit_reset)
+            await db.listen(PROMPTS_CHANGED_CHANNEL, on_prompts_changed)
+
+        if config.quota_ledger and config.shared_state:
+            # счетчики в памяти одной реплики не видят запросов, принятых другими
+            logging.warning("QUOTA_LEDGER не используется при SHARED_STATE, лимиты проверяются по БД")
+        elif config.quota_ledger:
+            # лимиты проверяются в памяти, счетчики пишутся в БД пачками
+            db.ledger = QuotaLedger(db, config.quota_flush_interval, config.quota_flush_max_pending)
+            await db.ledger.start()
+
+        if config.response_cache_shared:
+            open_ai.response_cache.attach_db(db)  # общий кэш ответов для всех реплик
+
+        if config.wiki_enabled:
+            identification.init()  # клиенты Википедии и файл ее кэша
 
         # Создание асинхронной задачи для сброса
         reset_task = asyncio.create_task(reset_tasks())
@@ -83,35 +141,54 @@ async def shutdown():
                 pass
 
         if db:
+            if db.ledger is not None:
+                try:
+                    await db.ledger.stop()  # дописываем накопленные счетчики перед закрытием пула
+                except Exception as e:
+                    # счетчики уже не сохранить, но пул и клиенты все равно надо закрыть
+                    logging.error(f"Не удалось записать счетчики запросов при остановке: {e}")
             await db.close_pool()
             logging.info("Соединение с базой данных закрыто")
+
+        await open_ai.close()
+        await identification.close()
     except Exception as e:
         logging.error(f"Ошибка при закрытии соединения с базой данных: {e}")
         raise
 
+
+# общая подготовка для обоих режимов: БД, мидлвари и меню команд
+async def prepare():
+    await startup()
+
+    # первым: апдейты одного пользователя по очереди, проверки лимитов и FSM внутри уже без гонок;
+    # фото одного альбома здесь же собираются в одно событие
+    dp.update.outer_middleware(UserSerialMiddleware(config.dispatch_max_in_flight, config.media_group_latency))
+    dp.update.middleware(DatabaseMiddleware(db))
+    dp.update.middleware(ThrottlingMiddleware(cache_limit))
+
+    await bot.set_my_commands([
+        BotCommand(command="/start", description="Запустить бота"),
+        BotCommand(command="/help", description="Показать справку"),
+        BotCommand(command="/buy", description="Купить/проверить подписку"),
+        BotCommand(command="/prompts", description="Показать мои промпты"),
+        BotCommand(command="/add", description="Добавить новый промпт"),
+        BotCommand(command="/edit", description="Редактировать промпт"),
+        BotCommand(command="/delete", description="Удалить промпт"),
+        BotCommand(command="/cancel", description="Отменить команду")
+    ])
+
+
 async def main():
     try:
         # Регистрируем роутеры в диспетчере
         dp.include_router(command_handler.router)
         dp.include_router(prompt_handler.router)
 
-        await startup()
-
-        dp.update.middleware(DatabaseMiddleware(db))
-        dp.update.middleware(ThrottlingMiddleware(cache_limit))
-
-        await bot.set_my_commands([
-            BotCommand(command="/start", description="Запустить бота"),
-            BotCommand(command="/help", description="Показать справку"),
-            BotCommand(command="/buy", description="Купить/проверить подписку"),
-            BotCommand(command="/prompts", description="Показать мои промпты"),
-            BotCommand(command="/add", description="Добавить новый промпт"),
-            BotCommand(command="/edit", description="Редактировать промпт"),
-            BotCommand(command="/delete", description="Удалить промпт"),
-            BotCommand(command="/cancel", description="Отменить команду")
-        ])
+        await prepare()
 
         logging.info('Запускаем бота')
+        await bot.delete_webhook(drop_pending_updates=False)  # при возврате с вебхука, иначе getUpdates недоступен
         await dp.start_polling(bot, skip_updates=False) #  Это спасет от проблем при обработке платежей.
     except Exception as e:
         logging.error(f"Ошибка при работе бота: {e}")
@@ -119,5 +196,38 @@ async def main():
         await shutdown()
 
 
+async def on_webhook_startup():
+    await prepare()
+    await bot.set_webhook(
+        f"{config.webhook_url}{config.webhook_path}",
+        secret_token=config.webhook_secret,
+        max_connections=config.webhook_max_connections,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,  # как и при поллинге, не теряем платежи
+    )
+    logging.info('Запускаем бота в режиме вебхука')
+
+
+# Вебхук: апдейты принимает aiohttp-сервер, поэтому реплик за балансировщиком может быть несколько
+def run_webhook():
+    if not config.webhook_url or not config.webhook_secret:
+        raise ValueError("Для режима вебхука нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+    dp.include_router(command_handler.router)
+    dp.include_router(prompt_handler.router)
+    dp.startup.register(on_webhook_startup)
+    dp.shutdown.register(shutdown)
+
+    app = web.Application()
+    # запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются с 401
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=config.webhook_secret).register(
+        app, path=config.webhook_path)
+    setup_application(app, dp, bot=bot)  # связывает старт и остановку приложения с диспетчером
+    web.run_app(app, host=config.webhook_host, port=config.webhook_port)
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    if config.bot_mode == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(main())
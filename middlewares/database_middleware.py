@@ -1,15 +1,30 @@
+import logging
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject
+from aiogram.types import TelegramObject, User
+from cachetools import LRUCache
 from typing import Callable, Dict, Any, Awaitable
 from database.db import Database
 
 
 class DatabaseMiddleware(BaseMiddleware):
-    def __init__(self, db: Database):
+    """Передает БД в хэндлеры и заводит строку users незнакомому пользователю до того, как они сработают.
+
+    Оплата и промпты пишут в таблицы со ссылкой на users, поэтому строка нужна не только после /start.
+    Уже заведенные id запоминаются в процессе, и повторные апдейты в БД не ходят."""
+
+    def __init__(self, db: Database, known_users_size: int = 100_000):
         super().__init__()
         self.db = db
+        self.known_users = LRUCache(maxsize=known_users_size)
 
     async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
                        data: Dict[str, Any]) -> Any:
         data['db'] = self.db
+        user: User = data.get('event_from_user')
+        if user is not None and user.id not in self.known_users:
+            try:
+                await self.db.add_user(user.id)  # ON CONFLICT DO NOTHING - для зарегистрированных ничего не меняет
+                self.known_users[user.id] = True
+            except Exception as e:
+                logging.error(f"Не удалось зарегистрировать пользователя {user.id}: {e}")
         return await handler(event, data)
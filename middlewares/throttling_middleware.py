@@ -3,7 +3,7 @@ from typing import Any, Dict, Awaitable, Callable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject, User, CallbackQuery, InlineQuery, Update
 from cachetools import TTLCache
-from database.db import Database
+from time_delta import get_today
 
 
 class ThrottlingMiddleware(BaseMiddleware):
@@ -16,17 +16,10 @@ class ThrottlingMiddleware(BaseMiddleware):
         try:
             user: User = data.get('event_from_user')
             if user is not None:
-                if self.cache_limit and user.id in self.cache_limit:
-                    await self._send_limit_exceeded_message(event)
-                    return  # не пропускать апдейт в следующий роутер
-
-                # Проверка лимитов в базе данных, если пользователя нет в кэше
-                db: Database = data.get('db')
-                if db is None:
-                    raise ValueError("Не задана БД")
-
-                if not await db.check_limits(user.id):
-                    self.cache_limit[user.id] = True  # лимит исчерпан
+                # в БД здесь не ходим: лимит проверяется атомарным резервом запроса перед обращением
+                # к нейросети, а отказ в резерве попадает в этот кэш (Database.reserve_request)
+                key = (user.id, get_today())
+                if self.cache_limit and key in self.cache_limit:
                     await self._send_limit_exceeded_message(event)
                     return  # не пропускать апдейт в следующий роутер
 
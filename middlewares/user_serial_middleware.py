@@ -0,0 +1,85 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject, Update, User
+
+# апдейты, которые нельзя держать в очереди за долгим запросом пользователя
+BYPASS_COMMANDS = {'/cancel'}  # иначе отменять будет нечего - запрос уже закончится
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются строго по очереди, разных - параллельно.
+
+    Так проверка лимита, запрос и увеличение счетчика одного пользователя не перемешиваются,
+    как и переходы его FSM. Всего одновременно обрабатывается не больше max_in_flight апдейтов.
+    Очередь пользователя удаляется, как только в ней никого не осталось.
+
+    Фото альбома Telegram присылает отдельными апдейтами с общим media_group_id. Первое фото
+    заводит альбом сразу, еще до очереди, остальные только дописываются в него и хэндлер не видят.
+    Дождавшись очереди и media_group_latency секунд с прихода, первое фото уходит в хэндлер
+    вместе со всем альбомом в data['album']."""
+
+    def __init__(self, max_in_flight: int, media_group_latency: float):
+        super().__init__()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.media_group_latency = media_group_latency
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.waiters: Dict[int, int] = {}  # сколько апдейтов пользователя ждут или обрабатываются
+        self.albums: Dict[Tuple[int, str], List[Message]] = {}  # альбомы, первое фото которых уже в очереди
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]], event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        user: User = data.get('event_from_user')
+        if user is None or self._bypass(event):
+            return await handler(event, data)
+
+        key = self._album(event)
+        album = None
+        if key is not None:
+            album = self.albums.get(key)
+            if album is not None:
+                album.append(event.message)
+                return  # альбом обработает его первое фото
+            album = self.albums[key] = [event.message]
+        arrived = asyncio.get_running_loop().time()
+
+        lock = self.locks.get(user.id)
+        if lock is None:
+            lock = self.locks[user.id] = asyncio.Lock()
+        self.waiters[user.id] = self.waiters.get(user.id, 0) + 1
+        try:
+            async with lock:
+                if album is not None:
+                    # ждем остальные фото уже в очереди, чтобы следующий апдейт пользователя не обогнал альбом
+                    delay = self.media_group_latency - (asyncio.get_running_loop().time() - arrived)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if self.albums.get(key) is album:
+                        del self.albums[key]
+                    album.sort(key=lambda message: message.message_id)
+                    data['album'] = album
+                async with self.in_flight:
+                    return await handler(event, data)
+        finally:
+            self.waiters[user.id] -= 1
+            if not self.waiters[user.id]:
+                del self.waiters[user.id]
+                del self.locks[user.id]
+            if album is not None and self.albums.get(key) is album:
+                del self.albums[key]  # апдейт отменили, пока он ждал очереди
+
+    @staticmethod
+    def _bypass(event: TelegramObject) -> bool:
+        if not isinstance(event, Update):
+            return False
+        if event.pre_checkout_query is not None:
+            return True  # Telegram ждет ответа на предоплату не дольше десяти секунд
+        text = event.message.text if event.message else None
+        return bool(text) and text.split(maxsplit=1)[0].split('@')[0] in BYPASS_COMMANDS
+
+    @staticmethod
+    def _album(event: TelegramObject) -> Optional[Tuple[int, str]]:
+        if isinstance(event, Update) and event.message and event.message.media_group_id:
+            return event.message.chat.id, event.message.media_group_id
+        return None
@@ -0,0 +1,7 @@
+from datetime import date
+from typing import NamedTuple
+
+
+class Reservation(NamedTuple):
+    daily_requests: int  # значение суточного счетчика вместе с этим запросом
+    day: date  # день, к которому отнесен запрос
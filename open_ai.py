@@ -1,54 +1,175 @@
+import asyncio
 import logging
+import time
+import weakref
+from typing import Awaitable, Callable, List, Optional
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 from config import Config
+from llm_scheduler import LLMScheduler, SchedulerOverloadedError, PRIORITY_FREE
+from photo_cache import LOW_DETAIL_TOKENS, PhotoCache
+from response_cache import ResponseCache, make_key
 import base64
 
 config = Config()
 
-client = OpenAI(
+# Асинхронный клиент держит общий пул соединений, поэтому создаем его один раз на процесс
+client = AsyncOpenAI(
     # This is the default and can be omitted
     api_key=config.openai_key,
+    base_url=config.openai_base_url,
+    timeout=config.openai_timeout,
+    max_retries=config.openai_max_retries,
 )
 
+MODEL = "gpt-4o"
+MAX_TOKENS = 1000
+# оценка сверху для одного изображения: detail=low стоит фиксированно, high/auto до 765 для фото из Telegram
+IMAGE_TOKENS = LOW_DETAIL_TOKENS if config.photo_detail == 'low' else 765
+
+# общий лимит параллельности, бюджет токенов в минуту и приоритет платных пользователей
+scheduler = LLMScheduler(
+    max_concurrency=config.openai_max_concurrency,
+    tokens_per_minute=config.openai_tokens_per_minute,
+    max_queue_size=config.openai_max_queue,
+)
+
+# одинаковые запросы к одним и тем же промптам не оплачиваем повторно
+response_cache = ResponseCache(
+    max_size=config.response_cache_size,
+    ttl=config.response_cache_ttl,
+    max_rows=config.response_cache_max_rows,
+)
+
+# повторно присланные и пересланные фото узнаем по file_unique_id и перцептивному хэшу
+photo_cache = PhotoCache(
+    max_size=config.photo_cache_size,
+    ttl=config.photo_cache_ttl,
+    max_distance=config.photo_cache_distance,
+)
+
+# текущие запросы пользователей, чтобы их можно было отменить командой /cancel
+_active_requests: dict[int, asyncio.Task] = {}
+_cancelled_requests: weakref.WeakSet = weakref.WeakSet()
+
+
+class RequestCancelledError(Exception):
+    """Запрос к OpenAI отменен пользователем."""
+
+
+# фото передаем самим содержимым, а не ссылкой: так провайдер не видит токен бота и ничего не скачивает
+def make_data_url(image: bytes, mime_type: str = "image/jpeg") -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(image).decode('ascii')}"
+
+
+def estimate_tokens(content: list) -> int:
+    tokens = MAX_TOKENS
+    for part in content:
+        if part["type"] == "text":
+            tokens += len(part["text"]) // 4 + 1  # грубая оценка: ~4 символа на токен
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+async def _create_completion(content: list, priority: int) -> str:
+    async with scheduler.slot(priority, estimate_tokens(content)):
+        response = await client.chat.completions.create(
+            model=MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": content,
+                }
+            ],
+            max_tokens=MAX_TOKENS,
+        )
+    if not response.choices or not response.choices[0].message.content:
+        raise ValueError("Ответ от API не содержит 'choices' или список пуст.")
+    return response.choices[0].message.content.strip()
+
+
+# Потоковый вариант: on_update получает весь накопленный текст после каждого фрагмента
+async def _stream_completion(content: list, priority: int, on_update: Callable[[str], Awaitable[None]]) -> str:
+    async with scheduler.slot(priority, estimate_tokens(content)):
+        stream = await client.chat.completions.create(
+            model=MODEL,
+            messages=[
+                {
+                    "role": "user",
+                    "content": content,
+                }
+            ],
+            max_tokens=MAX_TOKENS,
+            stream=True,
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            await on_update("".join(parts))
+    text = "".join(parts).strip()
+    if not text:
+        raise ValueError("Поток от API не содержит текста ответа.")
+    return text
+
 
 # Получаем ответ от OpenAI API
-def get_openai_response(url: str = None, prompt_text: str = None):
+async def get_openai_response(url: str = None, prompt_text: str = None, user_id: int = None,
+                              priority: int = PRIORITY_FREE,
+                              on_update: Optional[Callable[[str], Awaitable[None]]] = None,
+                              images: Optional[List[str]] = None):
     try:
-        if not url and not prompt_text:
+        # images - несколько фото (например, альбом), которые уходят в модель одним запросом
+        images = ([url] if url else []) + (images or [])
+        if not images and not prompt_text:
             return "Не задан запрос"
         content = []
-        if url and not prompt_text:
+        if images and not prompt_text:
             prompt_text = "Что на фото?"
         content.append({"type": "text", "text": prompt_text})
-        if url:
+        for image in images:
             content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": url,
+                    "url": image,
+                    "detail": config.photo_detail,
                 },
             })
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": content,
-                }
-            ],
-            max_tokens=1000,
-        )
-   #     print(response)
-        # Проверка ответа на наличие необходимых данных
-   #     if 'choices' not in response or not response['choices']:
-   #         raise ValueError("Ответ от API не содержит 'choices' или список пуст.")
 
-    #    first_choice = response['choices'][0]
-    #    if 'message' not in first_choice or 'content' not in first_choice['message']:
-    #        raise ValueError("Первый выбор не содержит 'message' или 'content'.")
+        key = make_key(MODEL, prompt_text, image="\n".join(images) or None) if config.response_cache_enabled else None
+        if key:
+            cached = await response_cache.get(key)
+            if cached:
+                return cached
 
-#        return response['choices'][0]['message']['content'].strip()
-        return response.choices[0].message.content.strip()
+        if on_update is not None:
+            task = asyncio.create_task(_stream_completion(content, priority, on_update))
+        else:
+            task = asyncio.create_task(_create_completion(content, priority))
+        if user_id is not None:
+            _active_requests[user_id] = task
+        try:
+            start = time.monotonic()
+            reply = await task
+            if key:
+                await response_cache.put(key, reply, time.monotonic() - start)
+            return reply
+        except asyncio.CancelledError:
+            if task in _cancelled_requests:
+                raise RequestCancelledError(f"Запрос пользователя {user_id} отменен")
+            raise
+        finally:
+            if user_id is not None and _active_requests.get(user_id) is task:
+                del _active_requests[user_id]
+
+    except RequestCancelledError as e:
+        logging.info(f"{e}")
+        raise
+
+    except SchedulerOverloadedError:
+        raise
 
     except ValueError as e:
         logging.error(f"Ошибка в структуре ответа: {e}")
@@ -57,3 +178,16 @@ def get_openai_response(url: str = None, prompt_text: str = None):
     except Exception as e:
         logging.error(f"Произошла ошибка при получении завершения чата: {e}")
         raise
+
+
+def cancel_user_request(user_id: int) -> bool:
+    task = _active_requests.pop(user_id, None)
+    if task is None or task.done():
+        return False
+    _cancelled_requests.add(task)
+    task.cancel()
+    return True
+
+
+async def close():
+    await client.close()
@@ -0,0 +1,113 @@
+import io
+import math
+from typing import List, NamedTuple, Optional, Tuple
+
+from cachetools import TTLCache
+from PIL import Image
+
+from response_cache import normalize_text
+
+
+def dhash(image: bytes, hash_size: int = 8) -> int:
+    # разностный хэш: сравниваем соседние пиксели уменьшенной серой копии,
+    # поэтому пересжатие, пересылка и другой размер того же фото почти не меняют биты
+    with Image.open(io.BytesIO(image)) as img:
+        pixels = list(img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+LOW_DETAIL_TOKENS = 85  # detail=low стоит одинаково при любом размере фото
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str = 'high') -> int:
+    if detail == 'low':
+        return LOW_DETAIL_TOKENS
+    # расчет OpenAI для detail=high: вписываем в 2048x2048, короткую сторону ужимаем до 768,
+    # дальше 170 токенов за каждую плитку 512x512 и 85 базовых
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+class CachedPhoto(NamedTuple):
+    response: str
+    tokens: int  # сколько токенов изображений стоил бы повторный запрос
+    images: Tuple[str, ...] = ()  # картинки из Википедии, которые уходят вслед за ответом
+
+
+class PhotoCache:
+    """Кэш ответов на фото: одно и то же фото с тем же промптом повторно не распознаем.
+
+    Сначала ищем по file_unique_id - он совпадает у пересланных копий и не требует
+    скачивания файла. Если его нет, сравниваем перцептивный хэш с уже виденными
+    фото по тому же промпту и принимаем совпадение с расстоянием Хэмминга не больше max_distance."""
+
+    def __init__(self, max_size: int, ttl: int, max_distance: int):
+        self.max_distance = max_distance
+        self._by_file = TTLCache(maxsize=max_size, ttl=ttl)
+        self._by_hash = TTLCache(maxsize=max_size, ttl=ttl)
+
+        self.file_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def get_by_file(self, file_unique_id: str, prompt_text: str | None) -> Optional[CachedPhoto]:
+        value: Optional[CachedPhoto] = self._by_file.get((file_unique_id, normalize_text(prompt_text)))
+        if value is None:
+            return None
+        self.file_hits += 1
+        self.saved_tokens += value.tokens
+        return value
+
+    def get_by_hash(self, image_hash: Optional[int], prompt_text: str | None) -> Optional[CachedPhoto]:
+        prompt = normalize_text(prompt_text)
+        value: Optional[CachedPhoto] = None
+        if image_hash is not None:
+            value = self._by_hash.get((image_hash, prompt))
+        if value is None and image_hash is not None and self.max_distance > 0:
+            # кэш ограничен по размеру, так что линейный проход по нему дешевле запроса к нейросети
+            best = self.max_distance + 1
+            for (cached_hash, cached_prompt), cached_value in list(self._by_hash.items()):
+                if cached_prompt != prompt:
+                    continue
+                distance = hamming(image_hash, cached_hash)
+                if distance < best:
+                    best, value = distance, cached_value
+        if value is None:
+            self.misses += 1
+            return None
+        self.hash_hits += 1
+        self.saved_tokens += value.tokens
+        return value
+
+    def put(self, file_unique_id: str, image_hash: Optional[int], prompt_text: str | None, response: str,
+            tokens: int, images: List[str] = ()):
+        prompt = normalize_text(prompt_text)
+        value = CachedPhoto(response, tokens, tuple(images))
+        self._by_file[(file_unique_id, prompt)] = value
+        if image_hash is not None:
+            self._by_hash[(image_hash, prompt)] = value
+
+    def stats(self) -> dict:
+        lookups = self.file_hits + self.hash_hits + self.misses
+        return {
+            'file_hits': self.file_hits,
+            'hash_hits': self.hash_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.file_hits + self.hash_hits) / lookups if lookups else 0.0,
+            'saved_tokens': self.saved_tokens,
+            'entries': len(self._by_file),
+        }
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import re
+from typing import Optional, Tuple
+
+from cachetools import TTLCache
+
+from database.db import Database
+
+
+def normalize_text(text: str | None) -> str:
+    # почти одинаковые запросы (регистр, лишние пробелы и переводы строк) дают один ключ
+    if not text:
+        return ""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def make_key(model: str, prompt_text: str | None, query_text: str | None = None, image: str | None = None) -> str:
+    image_hash = hashlib.sha256(image.encode()).hexdigest() if image else ""
+    payload = json.dumps([model, normalize_text(prompt_text), normalize_text(query_text), image_hash],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Кэш ответов нейросети: LRU в памяти процесса и, по желанию, общая таблица в Postgres,
+    чтобы им пользовались все реплики бота."""
+
+    def __init__(self, max_size: int, ttl: int, max_rows: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_rows = max_rows
+        # размер считаем в символах ответа, а не в количестве записей
+        self.local = TTLCache(maxsize=max_size, ttl=ttl, getsizeof=lambda value: len(value[0]) or 1)
+        self.db: Optional[Database] = None
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def attach_db(self, db: Database):
+        self.db = db
+
+    async def get(self, key: str) -> Optional[str]:
+        value: Optional[Tuple[str, float]] = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+        elif self.db is not None:
+            try:
+                value = await self.db.get_cached_response(key, self.ttl)
+            except Exception as e:
+                logging.error(f"Ошибка при чтении общего кэша ответов: {e}")
+                value = None
+            if value is not None:
+                self.shared_hits += 1
+                self._put_local(key, value)
+
+        if value is None:
+            self.misses += 1
+            return None
+        self.saved_seconds += value[1]
+        return value[0]
+
+    async def put(self, key: str, response: str, latency: float):
+        self._put_local(key, (response, latency))
+        if self.db is not None:
+            try:
+                await self.db.put_cached_response(key, response, latency)
+            except Exception as e:
+                logging.error(f"Ошибка при записи в общий кэш ответов: {e}")
+
+    def _put_local(self, key: str, value: Tuple[str, float]):
+        if len(value[0]) > self.max_size:
+            return  # слишком большой ответ не помещается в кэш целиком
+        self.local[key] = value
+
+    async def prune(self):
+        if self.db is not None:
+            await self.db.prune_response_cache(self.ttl, self.max_rows)
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            'saved_seconds': self.saved_seconds,
+            'entries': len(self.local),
+        }
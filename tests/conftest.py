@@ -0,0 +1,27 @@
+import os
+import socket
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# config.Config читает окружение один раз при импорте, поэтому тестовые значения задаем до него;
+# клиент OpenAI ходит в мок-сервер на этом порту (tests/test_openai_load.py)
+MOCK_OPENAI_PORT = _free_port()
+
+os.environ.setdefault("BOT_TOKEN", "42:test")
+os.environ.setdefault("OPENAI_KEY", "test")
+os.environ.setdefault("OPENAI_BASE_URL", f"http://127.0.0.1:{MOCK_OPENAI_PORT}/v1")
+os.environ.setdefault("OPENAI_MAX_CONCURRENCY", "10")
+os.environ.setdefault("OPENAI_TOKENS_PER_MINUTE", "0")
+os.environ.setdefault("OPENAI_MAX_RETRIES", "0")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+os.environ.setdefault("COMMAND_LIST", "start,help")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+os.environ.setdefault("DEFAULT_PROMPTS", "Переведи на английский")
+os.environ.setdefault("PROVIDER_TOKEN", "test")
+os.environ.setdefault("CURRENCY", "RUB")
+os.environ.setdefault("PRICE", "10000")
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+import open_ai
+from config import config
+
+LATENCY = 0.2  # сколько мок-сервер "думает" над каждым запросом
+USERS = 30
+
+
+class MockCompletions:
+    """Локальный сервер вместо /v1/chat/completions: отвечает эхом с задержкой и считает параллельные запросы."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(LATENCY)
+        finally:
+            self.in_flight -= 1
+        question = body["messages"][0]["content"][0]["text"]
+        return web.json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"ответ на {question}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+
+def test_concurrent_users_are_served_in_parallel():
+    mock = MockCompletions()
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", mock.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", urlparse(config.openai_base_url).port).start()
+        try:
+            start = time.monotonic()
+            answers = await asyncio.gather(*(open_ai.get_openai_response(None, f"вопрос {user_id}", user_id)
+                                             for user_id in range(USERS)))
+            return answers, time.monotonic() - start
+        finally:
+            await open_ai.close()
+            await runner.cleanup()
+
+    answers, elapsed = asyncio.run(run())
+
+    assert answers == [f"ответ на вопрос {user_id}" for user_id in range(USERS)]
+    assert mock.requests == USERS
+    # параллельно ровно столько, сколько разрешает планировщик, - не по одному и не все сразу
+    assert mock.peak == config.openai_max_concurrency
+    # три волны по LATENCY плюс установка соединений; по одному вышло бы LATENCY * USERS = 6 с
+    assert elapsed < LATENCY * USERS / 3
@@ -0,0 +1,18 @@
+from photo_cache import PhotoCache
+
+IMAGES = ["https://upload.wikimedia.org/a.jpg", "https://upload.wikimedia.org/b.jpg"]
+
+
+def test_hit_returns_wiki_images():
+    cache = PhotoCache(max_size=10, ttl=60, max_distance=6)
+    cache.put("file", 0b1011, " [wiki:ru]", "Дуб черешчатый", 85, IMAGES)
+
+    by_file = cache.get_by_file("file", " [wiki:ru]")
+    assert by_file.response == "Дуб черешчатый"
+    assert list(by_file.images) == IMAGES
+
+    # то же фото, пересжатое при пересылке: хэш отличается на бит
+    by_hash = cache.get_by_hash(0b1010, " [wiki:ru]")
+    assert list(by_hash.images) == IMAGES
+    assert cache.get_by_file("file", " [wiki:en]") is None
+    assert cache.stats()['saved_tokens'] == 170
@@ -0,0 +1,28 @@
+from aiogram.types import PhotoSize
+
+from config import config
+from handlers.process_query import select_photo_size
+from photo_cache import estimate_vision_tokens
+
+# обычный набор размеров, который Telegram хранит для фото 4:3
+TELEGRAM_SIZES = [
+    PhotoSize(file_id=str(width), file_unique_id=str(width), width=width, height=width * 3 // 4)
+    for width in (90, 320, 800, 1280)
+]
+
+
+def test_default_target_skips_the_original():
+    photo = select_photo_size(TELEGRAM_SIZES, config.photo_target_size)
+    assert (photo.width, photo.height) == (800, 600)
+
+
+def test_default_detail_is_cheaper_than_the_original():
+    photo = select_photo_size(TELEGRAM_SIZES, config.photo_target_size)
+    original = TELEGRAM_SIZES[-1]
+    assert estimate_vision_tokens(original.width, original.height) == 765
+    assert estimate_vision_tokens(photo.width, photo.height, config.photo_detail) == 85
+
+
+def test_small_photo_falls_back_to_largest():
+    photo = select_photo_size(TELEGRAM_SIZES[:2], config.photo_target_size)
+    assert photo.width == 320
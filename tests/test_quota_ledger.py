@@ -0,0 +1,56 @@
+import asyncio
+from datetime import date
+
+from database import ledger as ledger_module
+from database.ledger import QuotaLedger
+
+USER_ID = 1
+YESTERDAY = date(2026, 10, 17)
+TODAY = date(2026, 10, 18)
+
+
+class IncrementsDb:
+    """Вместо БД: пользователь без запросов, приращения просто запоминаются."""
+
+    def __init__(self):
+        self.flushes = []
+
+    async def get_quota_state(self, telegram_id, today):
+        return {'daily_requests': 0, 'is_admin': False}
+
+    async def apply_request_increments(self, telegram_ids, daily, total, days):
+        self.flushes.append(list(zip(telegram_ids, daily, total, days)))
+
+
+def test_daily_only_delta_after_midnight_is_flushed(monkeypatch):
+    db = IncrementsDb()
+    ledger = QuotaLedger(db, flush_interval=60, max_pending=100)
+
+    async def run():
+        monkeypatch.setattr(ledger_module, "get_today", lambda: YESTERDAY)
+        reservation = await ledger.reserve(USER_ID, 10, 100)
+        await ledger.flush()
+
+        # резерв вчерашнего запроса вернули уже после полуночи, и сразу взяли сегодняшний
+        monkeypatch.setattr(ledger_module, "get_today", lambda: TODAY)
+        ledger.release(USER_ID, reservation)
+        await ledger.reserve(USER_ID, 10, 100)
+        await ledger.flush()
+
+    asyncio.run(run())
+    assert db.flushes == [[(USER_ID, 1, 1, YESTERDAY)], [(USER_ID, 1, 0, TODAY)]]
+
+
+def test_entry_with_daily_only_delta_is_not_evicted(monkeypatch):
+    ledger = QuotaLedger(IncrementsDb(), flush_interval=60, max_pending=100)
+
+    async def run():
+        monkeypatch.setattr(ledger_module, "get_today", lambda: TODAY)
+        await ledger.reserve(USER_ID, 10, 100)
+        entry = ledger.entries[USER_ID]
+        entry.pending_total = 0  # общий счетчик уже сошелся, суточный - нет
+        entry.day = YESTERDAY
+        ledger.evict_stale()
+
+    asyncio.run(run())
+    assert USER_ID in ledger.entries
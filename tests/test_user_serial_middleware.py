@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.types import Chat, Message, Update, User
+
+from middlewares.user_serial_middleware import UserSerialMiddleware
+
+USER = User(id=1, is_bot=False, first_name="test")
+LATENCY = 0.05
+
+
+def make_update(message_id: int, media_group_id: str = None) -> Update:
+    message = Message(message_id=message_id, date=datetime.now(), chat=Chat(id=USER.id, type="private"),
+                      from_user=USER, text=None if media_group_id else "text", media_group_id=media_group_id)
+    return Update(update_id=message_id, message=message)
+
+
+async def feed(middleware: UserSerialMiddleware, handler, update: Update):
+    return await middleware(handler, update, {'event_from_user': USER})
+
+
+def test_album_waits_behind_earlier_update():
+    calls = []
+    running = []
+
+    async def handler(update: Update, data: dict):
+        running.append(update.message.message_id)
+        assert len(running) == 1, "апдейты одного пользователя обработались параллельно"
+        calls.append((update.message.message_id, [m.message_id for m in data.get('album', [])]))
+        if update.message.message_id == 1:
+            await asyncio.sleep(LATENCY * 4)  # долгий текстовый запрос
+        running.remove(update.message.message_id)
+
+    async def run():
+        # семафор на один апдейт, чтобы альбом ждал и очереди пользователя, и общего лимита
+        middleware = UserSerialMiddleware(max_in_flight=1, media_group_latency=LATENCY)
+        first = asyncio.create_task(feed(middleware, handler, make_update(1)))
+        await asyncio.sleep(0)
+        photos = [asyncio.create_task(feed(middleware, handler, make_update(message_id, "album")))
+                  for message_id in (2, 3)]
+        await asyncio.gather(first, *photos)
+        return middleware
+
+    middleware = asyncio.run(run())
+    assert calls == [(1, []), (2, [2, 3])]
+    assert not middleware.albums and not middleware.locks and not middleware.waiters
+
+
+class RacyQuota:
+    """Проверка лимита и увеличение счетчика как отдельные запросы к БД, между которыми есть await.
+
+    Без очереди пользователя параллельные апдейты успевают проверить лимит до того, как кто-то его увеличит."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.daily_requests = 0
+
+    async def reserve(self) -> bool:
+        used = self.daily_requests
+        await asyncio.sleep(0)  # SELECT daily_requests ...
+        if used >= self.limit:
+            return False
+        self.daily_requests += 1  # UPDATE users SET daily_requests = daily_requests + 1
+        return True
+
+    async def release(self):
+        await asyncio.sleep(0)
+        self.daily_requests -= 1
+
+
+def run_quota(middleware: UserSerialMiddleware | None):
+    limit = 3
+    quota = RacyQuota(limit)
+    accepted = []
+
+    async def handler(update: Update, data: dict):
+        if not await quota.reserve():
+            return
+        await asyncio.sleep(0.01)  # запрос к модели
+        if update.message.message_id == 1:
+            await quota.release()  # ответ не доставлен - резерв возвращается
+        else:
+            accepted.append(update.message.message_id)
+
+    async def run():
+        updates = [make_update(message_id) for message_id in range(1, 6)]
+        updates += [make_update(message_id, "album") for message_id in (6, 7)]
+        if middleware is None:
+            await asyncio.gather(*(handler(update, {}) for update in updates))
+        else:
+            await asyncio.gather(*(feed(middleware, handler, update) for update in updates))
+
+    asyncio.run(run())
+    return limit, quota, accepted
+
+
+def test_quota_never_exceeds_limit():
+    limit, quota, accepted = run_quota(UserSerialMiddleware(max_in_flight=10, media_group_latency=LATENCY))
+    assert accepted == [2, 3, 4]
+    assert quota.daily_requests == limit
+
+
+def test_quota_overshoots_without_middleware():
+    # та же нагрузка без очереди: проверка выше что-то доказывает, только если здесь лимит превышен
+    limit, quota, accepted = run_quota(None)
+    assert len(accepted) > limit
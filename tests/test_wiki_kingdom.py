@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import pytest
+
+from wiki import KINGDOM_EXTRACTORS, get_kingdom, normalize_kingdom
+
+FIXTURES = Path(__file__).parent / "fixtures" / "wiki"
+
+
+def lead_html(name: str) -> str:
+    # нулевая секция статьи в том виде, в каком ее отдает action=parse
+    return (FIXTURES / name).read_text(encoding="utf-8")
+
+
+@pytest.mark.parametrize("language, fixture, kingdom", [
+    ("en", "en_quercus_robur.html", "Plantae"),  # <table class="infobox biota">
+    ("ru", "ru_quercus_robur.html", "Растения"),  # ts-Taxonomy-rang с закодированной ссылкой
+])
+def test_kingdom_from_lead_section(language, fixture, kingdom):
+    extracted = KINGDOM_EXTRACTORS[language](lead_html(fixture))
+    assert extracted == kingdom
+    assert normalize_kingdom(extracted) == "Plantae"
+
+
+def test_plain_infobox_class():
+    html = '<table class="infobox"><tr><td>Kingdom:</td><td>Fungi</td></tr></table>'
+    assert get_kingdom(html) == "Fungi"
+
+
+def test_page_without_taxobox():
+    html = '<div class="mw-parser-output"><table class="infobox vcard"><tr><td>Born</td><td>1809</td></tr></table></div>'
+    assert get_kingdom(html) is None
@@ -0,0 +1,16 @@
+import pytest
+
+from identification import IdentificationPipeline
+
+
+@pytest.mark.parametrize("language_code, expected", [
+    ("en", "en"),
+    ("en-US", "en"),
+    ("ru", "ru"),
+    ("de", "ru"),  # раздела нет в WIKI_LANGUAGES - берем раздел по умолчанию
+    ("uk", "ru"),  # для раздела нет разборщика царства
+    (None, "ru"),
+])
+def test_pick_language(language_code, expected):
+    pipeline = IdentificationPipeline(engine=None, language="ru", top_k=3, languages=["ru", "en", "uk"])
+    assert pipeline.pick_language(language_code) == expected
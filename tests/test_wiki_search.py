@@ -0,0 +1,128 @@
+import asyncio
+from pathlib import Path
+
+from aiohttp import web
+
+from wiki import Wiki
+from wiki_cache import WikiCache
+
+FIXTURES = Path(__file__).parent / "fixtures" / "wiki"
+PLANT_HTML = (FIXTURES / "en_quercus_robur.html").read_text(encoding="utf-8")
+ANIMAL_HTML = PLANT_HTML.replace('title="Plant">Plantae', 'title="Animal">Animalia')
+
+
+class FixtureApi:
+    """MediaWiki API на локальном порту: ответы собраны из сохраненных преамбул статей.
+
+    pages: название -> (html преамбулы, задержка ответа parse в секундах)."""
+
+    def __init__(self, search_results, pages):
+        self.search_results = search_results
+        self.pages = pages
+        self.calls = []  # (action, название) в порядке прихода
+
+    async def handle(self, request: web.Request) -> web.Response:
+        params = request.query
+        if params.get("list") == "search":
+            self.calls.append(("search", params["srsearch"]))
+            return web.json_response({"query": {"search": [{"title": t} for t in self.search_results]}})
+        if params.get("action") == "parse":
+            title = params["page"]
+            self.calls.append(("parse", title))
+            html, delay = self.pages[title]
+            await asyncio.sleep(delay)
+            return web.json_response({"parse": {"title": title, "revid": 1, "text": html}})
+        if params.get("generator") == "images":
+            self.calls.append(("images", params["titles"]))
+            return web.json_response({"query": {"pages": []}})
+        title = params["titles"]
+        self.calls.append(("info", title))
+        return web.json_response({"query": {"pages": [{
+            "title": title, "lastrevid": 1,
+            "fullurl": f"https://en.wikipedia.org/wiki/{title.replace(' ', '_')}", "extract": f"{title}.",
+        }]}})
+
+    def parsed(self):
+        return [title for action, title in self.calls if action == "parse"]
+
+
+async def serve(api: FixtureApi, wiki: Wiki, *calls):
+    app = web.Application()
+    app.router.add_get("/w/api.php", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    wiki.api_url = f"http://127.0.0.1:{port}/w/api.php"  # вместо настоящей Википедии
+    try:
+        return [await call() for call in calls]
+    finally:
+        await wiki.close()
+        await runner.cleanup()
+
+
+def test_best_ranked_match_wins_over_faster_one():
+    # первый результат поиска подходит, но отвечает дольше второго, который тоже подходит
+    api = FixtureApi(["Quercus robur", "Quercus petraea", "Oak gall wasp"], {
+        "Quercus robur": (PLANT_HTML, 0.3),
+        "Quercus petraea": (PLANT_HTML, 0.0),
+        "Oak gall wasp": (ANIMAL_HTML, 0.0),
+    })
+    wiki = Wiki("en")
+    [result] = asyncio.run(serve(api, wiki, lambda: wiki.get_wiki("Quercus robur", "Plantae")))
+    assert result[0] == "Quercus robur"
+    assert result[1] == "https://en.wikipedia.org/wiki/Quercus_robur"
+
+
+def test_lower_ranked_match_after_mismatches():
+    api = FixtureApi(["Oak gall wasp", "Quercus robur"], {
+        "Oak gall wasp": (ANIMAL_HTML, 0.1),
+        "Quercus robur": (PLANT_HTML, 0.0),
+    })
+    wiki = Wiki("en")
+    [result] = asyncio.run(serve(api, wiki, lambda: wiki.get_wiki("oak", "Растения")))
+    assert result[0] == "Quercus robur"
+
+
+def test_remaining_candidates_are_cancelled():
+    api = FixtureApi(["Quercus robur", "Slow page", "Slower page"], {
+        "Quercus robur": (PLANT_HTML, 0.0),
+        "Slow page": (ANIMAL_HTML, 5.0),
+        "Slower page": (ANIMAL_HTML, 10.0),
+    })
+    wiki = Wiki("en")
+
+    async def call():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        result = await wiki.get_wiki("Quercus robur", "Plantae")
+        # разбор остальных страниц не дожидаемся и не оставляем висеть
+        leftovers = [task for task in asyncio.all_tasks() if "_evaluate" in repr(task.get_coro())]
+        return result, loop.time() - start, leftovers
+
+    [(result, elapsed, leftovers)] = asyncio.run(serve(api, wiki, call))
+    assert result[0] == "Quercus robur"
+    assert elapsed < 2
+    assert leftovers == []
+
+
+def test_second_lookup_is_served_from_cache(tmp_path):
+    api = FixtureApi(["Oak gall wasp", "Quercus robur"], {
+        "Oak gall wasp": (ANIMAL_HTML, 0.0),
+        "Quercus robur": (PLANT_HTML, 0.0),
+    })
+    cache = WikiCache(str(tmp_path / "wiki_cache.sqlite3"))
+    wiki = Wiki("en", cache=cache)
+    try:
+        first, second = asyncio.run(serve(api, wiki,
+                                          lambda: wiki.get_wiki("oak", "Plantae"),
+                                          lambda: wiki.get_wiki("oak", "Plantae")))
+    finally:
+        cache.close()
+    assert first == second
+    assert first[0] == "Quercus robur"
+    # второй раз ни поиска, ни разбора, ни подробностей - все из кэша
+    assert [call for call in api.calls if call[0] == "search"] == [("search", "oak")]
+    assert sorted(api.parsed()) == ["Oak gall wasp", "Quercus robur"]
+    assert len([call for call in api.calls if call[0] == "info"]) == 1
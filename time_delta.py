@@ -1,5 +1,5 @@
 import logging
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, date
 import pytz
 
 
@@ -13,4 +13,13 @@ def get_seconds_to_midnight(timezone: str = 'Europe/Moscow') -> float:
         raise ValueError(f"Неверное имя временной зоны: {timezone}")
     except Exception as e:
         logging.error(f"Ошибка при расчете времени до полуночи: {e}")
-        raise RuntimeError(f"Ошибка при расчете времени до полуночи: {e}")
\ No newline at end of file
+        raise RuntimeError(f"Ошибка при расчете времени до полуночи: {e}")
+
+
+# текущая дата в часовом поясе, по которому сбрасываются суточные лимиты
+def get_today(timezone: str = 'Europe/Moscow') -> date:
+    try:
+        return datetime.now(pytz.timezone(timezone)).date()
+    except pytz.UnknownTimeZoneError as e:
+        logging.error(f"Неверное имя временной зоны: {e}")
+        raise ValueError(f"Неверное имя временной зоны: {timezone}")
\ No newline at end of file
@@ -1,65 +1,310 @@
-from typing import Tuple, Optional, List
+import asyncio
+import time
+from typing import Callable, Dict, Tuple, Optional, List
 
-import wikipedia
+import aiohttp
 import re
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import logging
 
+from wiki_cache import WikiCache, WikiPage
+
+USER_AGENT = "wikibot/1.0 (https://github.com/AstFreelancer/wikibot)"  # MediaWiki API требует представляться
+
+# разбираем только таблицу-таксобокс, остальная разметка в дерево не попадает;
+# класс сверяется по словам: в en-разделе таксобокс - это <table class="infobox biota">
+INFOBOX_CLASS = re.compile(r"\binfobox\b")
+INFOBOX_STRAINER = SoupStrainer("table", class_=INFOBOX_CLASS)
+
+# форматы, которые Telegram показывает как фото; svg, gif, tiff, pdf и т.п. отбрасываем
+RASTER_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
+MIN_IMAGE_SIDE = 100  # значки и пиктограммы из шаблонов статье не нужны
+
+
+def get_kingdom(html_content: str) -> str | None:
+    start = html_content.find('<table class="infobox')
+    if start == -1:
+        return None
+    soup = BeautifulSoup(html_content[start:], "html.parser", parse_only=INFOBOX_STRAINER)
+
+    taxobox = soup.find("table", class_=INFOBOX_CLASS)
+
+    if taxobox:
+        for row in taxobox.find_all('tr'):
+            cols = row.find_all('td')
+            if len(cols) >= 2 and 'Kingdom' in cols[0].get_text():
+                return cols[1].get_text().strip()
+
+    return None
+
+
+def get_regnum(text: str) -> str | None:
+    try:
+        index = text.find('<div class="ts-Taxonomy-rang-label" style="color:inherit">Царство:</div>')
+        if index == -1:
+            return None
+
+        # ссылка в API закодирована (%D0%A0...), поэтому берем всю строку царства, а не фиксированные 200 символов
+        end = text.find('ts-Taxonomy-rang-row', index)
+        substring = text[index:end if end != -1 else index + 1000]
+        kingdom = re.search(r'<a href=[^>]+title="(\w+)">\w+</a></div>', substring)
+        if not kingdom:
+            return None
+        return kingdom[1]
+    except Exception as e:
+        logging.info(f"Произошла ошибка: {e}")
+    return None
+
+
+# Таксобоксы в разных разделах Википедии оформлены по-разному, поэтому у каждого языка свой разборщик
+KINGDOM_EXTRACTORS: Dict[str, Callable[[str], Optional[str]]] = {
+    "ru": get_regnum,
+    "en": get_kingdom,
+}
+
+
+def register_kingdom_extractor(language: str, extractor: Callable[[str], Optional[str]]):
+    KINGDOM_EXTRACTORS[language] = extractor
+
+
+# ru-раздел дает название царства по-русски, en - по-латыни; сравниваем по латинскому названию
+KINGDOM_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "Plantae": ("Растения",),
+    "Animalia": ("Животные",),
+    "Fungi": ("Грибы",),
+    "Bacteria": ("Бактерии",),
+    "Archaea": ("Археи",),
+    "Protozoa": ("Простейшие", "Протисты", "Protista"),
+    "Chromista": ("Хромисты",),
+}
+_KINGDOM_LOOKUP = {alias.casefold(): latin for latin, aliases in KINGDOM_ALIASES.items()
+                   for alias in (latin,) + aliases}
+
+
+def normalize_kingdom(kingdom: str | None) -> str | None:
+    if not kingdom:
+        return None
+    kingdom = re.sub(r"\[.*?\]", "", kingdom).strip()  # сноски вида Plantae[1]
+    return _KINGDOM_LOOKUP.get(kingdom.casefold(), kingdom)
+
+
+class WikiError(Exception):
+    """Ошибка, которую вернул MediaWiki API."""
+
+
 class Wiki:
-    def __init__(self, language: str):
+    def __init__(self, language: str, max_concurrency: int = 5, timeout: float = 10.0,
+                 session: Optional[aiohttp.ClientSession] = None, cache: Optional[WikiCache] = None,
+                 thumb_width: int = 800):
         self.language = language
-        wikipedia.set_lang(language)
+        self.cache = cache
+        self.thumb_width = thumb_width  # ширина превью, которое отправляем вместо оригинала
+        self.api_url = f"https://{language}.wikipedia.org/w/api.php"
+        # для языков без своего разборщика пробуем англоязычную разметку таксобокса
+        self.extract_kingdom = KINGDOM_EXTRACTORS.get(language, get_kingdom)
+        self.max_concurrency = max_concurrency  # сколько страниц-кандидатов качаем одновременно
+        self.timeout = timeout
+        self._session = session
+        self._own_session = session is None
 
-    def get_kingdom(self, page) -> str | None:
-        html_content = page.html()
-        soup = BeautifulSoup(html_content, "html.parser")
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # одна сессия с пулом соединений на весь жизненный цикл объекта
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency * 2),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": USER_AGENT},
+            )
+            self._own_session = True
+        return self._session
 
-        taxobox = soup.find("table", {"class": "infobox"})
+    async def close(self):
+        if self._own_session and self._session is not None and not self._session.closed:
+            await self._session.close()
 
-        if taxobox:
-            for row in taxobox.find_all('tr'):
-                cols = row.find_all('td')
-                if len(cols) >= 2 and 'Kingdom' in cols[0].get_text():
-                    return cols[1].get_text().strip()
-        else:
-            logging.info(f"Taxobox для страницы '{page.title}' не найден!")
+    async def _api(self, **params) -> dict:
+        params.update(format="json", formatversion="2")
+        session = await self._get_session()
+        async with session.get(self.api_url, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+        if "error" in data:
+            raise WikiError(f"{data['error'].get('code')}: {data['error'].get('info')}")
+        return data
 
-        return None
+    async def search(self, query: str, limit: int = 10) -> List[str]:
+        if self.cache is not None:
+            titles = await self.cache.get_search(self.language, query)
+            if titles is not None:
+                return titles
+        data = await self._api(action="query", list="search", srsearch=query, srlimit=limit, srprop="")
+        titles = [item["title"] for item in data.get("query", {}).get("search", [])]
+        if self.cache is not None:
+            await self.cache.put_search(self.language, query, titles)
+        return titles
+
+    async def get_revisions(self, titles: List[str]) -> Dict[str, int]:
+        data = await self._api(action="query", titles="|".join(titles), prop="info")
+        return {page["title"]: page.get("lastrevid", 0) for page in data.get("query", {}).get("pages", [])}
 
-    def get_regnum(self, page) -> str | None:
+    # таксобокс всегда в преамбуле статьи, поэтому запрашиваем только нулевую секцию
+    async def get_lead_html(self, title: str) -> Optional[Tuple[str, str, int]]:
         try:
-            text = page.html()
-            index = text.find('<div class="ts-Taxonomy-rang-label" style="color:inherit">Царство:</div>')
-            if index == -1:
-                return None
-
-            substring = text[index:index+200]
-            kingdom = re.search(r'<a href=[^>]+title="(\w+)">\w+</a></div>', substring)
-            if not kingdom:
-                return None
-            return kingdom[1]
-        except Exception as e:
-            logging.info(f"Произошла ошибка: {e}")
-        return None
+            data = await self._api(action="parse", page=title, prop="text", section=0, redirects=1,
+                                   disablelimitreport=1, disableeditsection=1, disabletoc=1)
+        except WikiError as e:
+            logging.info(f"Страница не найдена для заголовка: {title} ({e})")
+            return None
+        parse = data.get("parse", {})
+        return parse.get("title", title), parse.get("text", ""), parse.get("revid", 0)
+
+    async def get_page_details(self, title: str) -> Tuple[str, str, List[str]]:
+        info, images = await asyncio.gather(
+            self._api(action="query", titles=title, prop="info|extracts", inprop="url",
+                      exintro=1, explaintext=1, redirects=1),
+            self.get_images(title),
+        )
+        pages = info.get("query", {}).get("pages", [])
+        page = pages[0] if pages else {}
+        return page.get("fullurl", ""), page.get("extract", ""), images
+
+    async def get_images(self, title: str) -> List[str]:
+        # один запрос на 50 файлов сразу с типом, размерами и ссылкой на превью нужной ширины
+        data = await self._api(action="query", titles=title, generator="images", gimlimit=50,
+                               prop="imageinfo", iiprop="url|mime|size", iiurlwidth=self.thumb_width,
+                               redirects=1)
+        images = []
+        for page in data.get("query", {}).get("pages", []):
+            if not page.get("imageinfo"):
+                continue
+            info = page["imageinfo"][0]
+            if info.get("mime") not in RASTER_MIME_TYPES:
+                continue
+            if min(info.get("width", 0), info.get("height", 0)) < MIN_IMAGE_SIDE:
+                continue
+            images.append(info.get("thumburl") or info["url"])
+        return images
+
+    async def _evaluate(self, title: str, semaphore: asyncio.Semaphore) -> Optional[WikiPage]:
+        async with semaphore:
+            logging.info(f"Анализ страницы {title}")
+            lead = await self.get_lead_html(title)
+        if lead is None:
+            return None
+        canonical_title, html_content, revid = lead
+        k = self.extract_kingdom(html_content)
+        if k is None:
+            logging.info(f"Taxobox для страницы '{canonical_title}' не найден!")
+        page = WikiPage(title=canonical_title, kingdom=k, revid=revid, checked_at=time.time())
+        if self.cache is not None:
+            await self.cache.put(self.language, title, page)
+        return page
+
+    async def _revalidate(self, pages: Dict[str, WikiPage]):
+        # устаревшие записи сверяем с текущей ревизией одним запросом на всех кандидатов
+        stale = {title: page for title, page in pages.items() if self.cache.is_stale(page)}
+        if not stale:
+            return
+        revisions = await self.get_revisions([page.title for page in stale.values()])
+        for title, page in stale.items():
+            if revisions.get(page.title) == page.revid:
+                page = page._replace(checked_at=time.time())
+                pages[title] = page
+                await self.cache.put(self.language, title, page)
+            else:
+                del pages[title]  # статью правили - разберем заново
 
-    # пока вернем просто первый с нужным царством
-    def get_wiki(self, query: str, kingdom: str) -> Optional[Tuple[str, str, str, List[str]]]:
+    async def _with_details(self, title: str, page: WikiPage) -> Tuple[str, str, str, List[str]]:
+        if page.url is None:
+            url, summary, images = await self.get_page_details(page.title)
+            page = page._replace(url=url, summary=summary, images=images)
+            if self.cache is not None:
+                await self.cache.put(self.language, title, page)
+        return page.title, page.url, page.summary, page.images
+
+    # первая в выдаче поиска страница с нужным царством
+    async def get_wiki(self, query: str, kingdom: str) -> Optional[Tuple[str, str, str, List[str]]]:
+        kingdom = normalize_kingdom(kingdom)
         try:
-            search_results = wikipedia.search(query)
+            search_results = await self.search(query)
+
+            # сначала смотрим, что уже известно из кэша, - это не стоит ни одного запроса
+            pages: Dict[str, WikiPage] = {}
+            if self.cache is not None:
+                for title in search_results:
+                    page = await self.cache.get(self.language, title)
+                    if page is not None:
+                        pages[title] = page
+                await self._revalidate(pages)
             for title in search_results:
-                logging.info(f"Анализ страницы {title}")
-                try:
-                    page = wikipedia.page(title)
-                    k = self.get_regnum(page) if self.language == "ru" else self.get_kingdom(page)
-                    if not k == kingdom:
-                        continue
-
-                    images = [file for file in page.images if not file.endswith('.svg')]
-                    return title, page.url, page.summary, images
-                except wikipedia.exceptions.DisambiguationError as e:
-                    logging.info(f"Дисамбигуация: {title} -> {e.options}")
-                except wikipedia.exceptions.PageError as e:
-                    logging.info(f"Страница не найдена для заголовка: {title}")
+                page = pages.get(title)
+                if page is None:
+                    break  # дальше нужны страницы, которых нет в кэше
+                if normalize_kingdom(page.kingdom) == kingdom:
+                    return await self._with_details(title, page)
+
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            tasks = {title: asyncio.create_task(self._evaluate(title, semaphore))
+                     for title in search_results if title not in pages}
+            try:
+                # страницы разбираются параллельно, но ответом будет более высокий в выдаче результат:
+                # следующий кандидат проверяется, только когда все предыдущие не подошли
+                for title in search_results:
+                    page = pages.get(title)
+                    if page is None:
+                        try:
+                            page = await tasks[title]
+                        except Exception as e:
+                            logging.info(f"Ошибка при анализе страницы {title}: {e}")
+                            continue
+                    if page is not None and normalize_kingdom(page.kingdom) == kingdom:
+                        return await self._with_details(title, page)
+            finally:
+                # нужное царство найдено - остальные страницы больше не нужны
+                for task in tasks.values():
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
         except Exception as e:
             logging.info(f"Общая ошибка: {e}")
         return None
+
+
+class WikiEngine:
+    """Набор клиентов Википедии для нескольких языков в одном процессе.
+
+    Все клиенты делят одну aiohttp-сессию и один кэш, поэтому ru и en запросы
+    можно обслуживать параллельно, не поднимая по процессу на язык."""
+
+    def __init__(self, max_concurrency: int = 5, timeout: float = 10.0, cache: Optional[WikiCache] = None,
+                 thumb_width: int = 800):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self.thumb_width = thumb_width
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._clients: Dict[str, Wiki] = {}
+
+    def get(self, language: str) -> Wiki:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency * 4),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": USER_AGENT},
+            )
+            self._clients.clear()  # старые клиенты держали закрытую сессию
+        client = self._clients.get(language)
+        if client is None:
+            client = Wiki(language, self.max_concurrency, self.timeout, session=self._session, cache=self.cache,
+                          thumb_width=self.thumb_width)
+            self._clients[language] = client
+        return client
+
+    async def get_wiki(self, language: str, query: str, kingdom: str) -> Optional[Tuple[str, str, str, List[str]]]:
+        return await self.get(language).get_wiki(query, kingdom)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._clients.clear()
+        if self.cache is not None:
+            self.cache.close()
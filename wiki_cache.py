@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+from cachetools import LRUCache
+
+
+class WikiPage(NamedTuple):
+    title: str  # каноническое название статьи (после редиректов)
+    kingdom: Optional[str]
+    revid: int
+    checked_at: float  # когда последний раз сверяли ревизию
+    url: Optional[str] = None  # подробности заполняются, только когда статья подошла
+    summary: Optional[str] = None
+    images: Optional[List[str]] = None
+
+
+class WikiCache:
+    """Кэш (язык, название статьи) -> царство и подробности статьи.
+
+    Спереди LRU в памяти процесса, сзади SQLite-файл, который переживает перезапуски.
+    Записи старше revalidate_after секунд сверяются с текущей ревизией статьи."""
+
+    def __init__(self, path: str, max_size: int = 10000, revalidate_after: int = 7 * 86400,
+                 search_ttl: int = 86400):
+        self.revalidate_after = revalidate_after
+        self.search_ttl = search_ttl
+        self._pages = LRUCache(maxsize=max_size)
+        self._searches = LRUCache(maxsize=max_size)
+        self._lock = threading.Lock()  # sqlite3-соединение используется из потоков to_thread
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS pages (
+                language TEXT NOT NULL,
+                title TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (language, title)
+            );
+            CREATE TABLE IF NOT EXISTS searches (
+                language TEXT NOT NULL,
+                query TEXT NOT NULL,
+                titles TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (language, query)
+            );
+        ''')
+
+    def _execute(self, query: str, *args) -> list:
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+            self._conn.commit()
+            return rows
+
+    def is_stale(self, page: WikiPage) -> bool:
+        return time.time() - page.checked_at > self.revalidate_after
+
+    async def get(self, language: str, title: str) -> Optional[WikiPage]:
+        page = self._pages.get((language, title))
+        if page is not None:
+            return page
+        try:
+            rows = await asyncio.to_thread(self._execute, 'SELECT data FROM pages WHERE language = ? AND title = ?',
+                                           language, title)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка чтения кэша Википедии: {e}")
+            return None
+        if not rows:
+            return None
+        page = WikiPage(**json.loads(rows[0][0]))
+        self._pages[(language, title)] = page
+        return page
+
+    async def put(self, language: str, title: str, page: WikiPage):
+        self._pages[(language, title)] = page
+        try:
+            await asyncio.to_thread(self._execute, 'INSERT OR REPLACE INTO pages (language, title, data) VALUES (?, ?, ?)',
+                                    language, title, json.dumps(page._asdict(), ensure_ascii=False))
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка записи в кэш Википедии: {e}")
+
+    async def get_search(self, language: str, query: str) -> Optional[List[str]]:
+        key = (language, query.strip().casefold())
+        cached = self._searches.get(key)
+        if cached is None:
+            try:
+                rows = await asyncio.to_thread(
+                    self._execute, 'SELECT titles, created_at FROM searches WHERE language = ? AND query = ?', *key)
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка чтения кэша Википедии: {e}")
+                return None
+            if not rows:
+                return None
+            cached = (json.loads(rows[0][0]), rows[0][1])
+            self._searches[key] = cached
+        titles, created_at = cached
+        if time.time() - created_at > self.search_ttl:
+            return None
+        return titles
+
+    async def put_search(self, language: str, query: str, titles: List[str]):
+        key = (language, query.strip().casefold())
+        created_at = time.time()
+        self._searches[key] = (titles, created_at)
+        try:
+            await asyncio.to_thread(
+                self._execute, 'INSERT OR REPLACE INTO searches (language, query, titles, created_at) VALUES (?, ?, ?, ?)',
+                *key, json.dumps(titles, ensure_ascii=False), created_at)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка записи в кэш Википедии: {e}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()